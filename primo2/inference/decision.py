@@ -64,7 +64,10 @@ class VariableElimination(object):
                 A joint factor with the given variable marginalized out.
         """
         tmp = factor[0].marginalize(variable)
-        return (tmp, (factor[0]*factor[1]).marginalize(variable)/tmp)
+        keep = [v for v in factor[0].variableOrder if v != variable]
+        keep.extend(v for v in factor[1].variableOrder
+                    if v != variable and v not in keep)
+        return (tmp, Factor.product_marginalize(factor, keep)/tmp)
 
     def generalized_VE(self, joint_factors, elimination_variables):
         """
@@ -21,16 +21,68 @@
 
 from __future__ import division 
 
+from collections import OrderedDict, deque
+import json
+import struct
+import zipfile
+
 import networkx as nx
+import numpy as np
 
 from .factor import Factor
 from .order import Orderer
+from .pruning import Pruner
+
+def _memory_map_npz(path):
+    """
+        Memory maps all arrays of an uncompressed .npz archive (as written by
+        np.savez) read-only, by locating the .npy data of each member within
+        the zip file. 
+        
+        Parameters
+        ----------
+        path : String
+            Path of the archive.
+            
+        Returns
+        -------
+            dict
+            Dictionary mapping the names of the arrays to np.memmaps.
+    """
+    arrays = {}
+    with zipfile.ZipFile(path) as archive:
+        with open(path, "rb") as f:
+            for info in archive.infolist():
+                if info.compress_type != zipfile.ZIP_STORED:
+                    raise ValueError("Only uncompressed archives can be " \
+                                     "memory mapped.")
+                #The local file header has a fixed size of 30 bytes, followed 
+                #by the file name and an extra field, whose lengths are
+                #stored at the end of the fixed part.
+                f.seek(info.header_offset)
+                nameLength, extraLength = struct.unpack("<HH", f.read(30)[26:30])
+                f.seek(info.header_offset + 30 + nameLength + extraLength)
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(f)
+                if dtype.hasobject:
+                    raise ValueError("Arrays containing objects cannot be " \
+                                     "memory mapped.")
+                name = info.filename
+                if name.endswith(".npy"):
+                    name = name[:-4]
+                arrays[name] = np.memmap(path, dtype=dtype, mode="r", shape=shape,
+                                         order="F" if fortranOrder else "C",
+                                         offset=f.tell())
+    return arrays
 
 class VariableElimination(object):
     
     
     @staticmethod
-    def naive_marginals(bn, variables, evidence=None):
+    def naive_marginals(bn, variables, evidence=None, prune=True):
         """
             Function to compute the prior or posterior marginals given evidence
             from a given Bayesian Network for the variables and their 
@@ -51,6 +103,9 @@ class VariableElimination(object):
                 the strength of the evidence for each outcome, e.g.:
                 For the binary evidence node E
                 evidence = {"E": "True"} is equivalent to {"E": np.array([1.0,0.0])}
+            prune : bool, optional
+                If set to True (default), the network is pruned to the part
+                relevant for the query first (see Pruner.prune_network).
                 
             Returns
             -------
@@ -60,6 +115,8 @@ class VariableElimination(object):
         
         if not evidence:
             evidence = {}
+        if prune:
+            bn, evidence = Pruner.prune_network(bn, variables, evidence)
         
         order = bn.get_all_node_names()
         # Compute joint probability distribution of all variables
@@ -83,7 +140,7 @@ class VariableElimination(object):
         
     
     @staticmethod
-    def bucket_marginals(bn, variables, evidence=None, order=None):
+    def bucket_marginals(bn, variables, evidence=None, order=None, prune=True):
         """
             Function to compute the prior or posterior marginals given evidence
             from a given Bayesian Network for the variables and their 
@@ -108,6 +165,10 @@ class VariableElimination(object):
             order : [String,], optional
                 List containing the elimination order of the nodes. If order is not
                 given, this algorithm computes the min degree order automatically.
+                Variables that are pruned are skipped.
+            prune : bool, optional
+                If set to True (default), the network is pruned to the part
+                relevant for the query first (see Pruner.prune_network).
                 
             Returns
             -------
@@ -115,65 +176,343 @@ class VariableElimination(object):
                 A factor containing the desired marginals
         """
         
-        if not order:
-            order = Orderer.get_min_degree_order(bn)
-            
         if not evidence:
             evidence = {}
+        if prune:
+            bn, evidence = Pruner.prune_network(bn, variables, evidence)
+            if order:
+                order = [v for v in order if v in bn.node_lookup]
         
-        #Move query variables at the end of the order
-        for v in variables:
-            order.remove(v)
-            order.append(v)
-            
-        factors = [Factor.from_node(bn.get_node(v)) for v in order]
+        if not order:
+            order = Orderer.get_min_degree_order(bn)
         
-        #Create buckets with trivial factors (one more than variables
-        #for trivial factors later
-        buckets = [Factor.get_trivial() for i in range(len(order)+1)]
+        #Eliminate the query variables last, without modifying the given order
+        order = [v for v in order if v not in variables] + list(variables)
+        position = {v: i for i, v in enumerate(order)}
         
         #Place factors in the first buckets they correlate to
-        for f in factors:
-            for i in range(len(order)):
-                if order[i] in f:
-                    buckets[i] = buckets[i] *f
-                    break                                        
+        buckets = [[] for v in order]
+        for v in order:
+            f = Factor.from_node(bn.get_node(v))
+            buckets[min(position[x] for x in f.variableOrder)].append(f)
 
         # Add evidence to buckets
-        for e in evidence.keys():
-            bucketI = order.index(e)
-            buckets[bucketI] = buckets[bucketI] * Factor.as_evidence(e, bn.get_node(e).values, evidence[e])
+        for e in evidence:
+            buckets[position[e]].append(Factor.as_evidence(e, bn.get_node(e).values, evidence[e]))
             
         bucketUntil = len(order)- len(variables)
+        #Factors without any variables that remain after eliminating a bucket
+        constants = []
         # Process buckets
         for i in range(bucketUntil):
-            tmpFactor = buckets[i].marginalize(order[i])
-            for j in range(i+1, len(order)):
-                if order[j] in tmpFactor:
-                    buckets[j] = buckets[j] * tmpFactor
-                    break
+            if not buckets[i]:
+                continue
+            #Multiply and sum out in one step without building the product
+            scope = []
+            for f in buckets[i]:
+                scope.extend(v for v in f.variableOrder if v not in scope)
+            scope.remove(order[i])
+            tmpFactor = Factor.product_marginalize(buckets[i], scope)
+            if tmpFactor.variableOrder:
+                buckets[min(position[x] for x in tmpFactor.variableOrder)].append(tmpFactor)
             else:
-                # No suitable bucket found -> factor is trivial
-                buckets[-1] = buckets[-1] * tmpFactor
+                constants.append(tmpFactor)
                 
-        #Compute marginals of intended variables
-        for i in range(bucketUntil, len(buckets)-1):
-            buckets[i+1] = buckets[i+1] * buckets[i]
+        #Compute marginals of intended variables in the order they were
+        #queried in
+        resFactor = Factor.product_marginalize(
+                [f for bucket in buckets[bucketUntil:] for f in bucket] + constants,
+                list(variables))
             
         # Normalize evidence
-        buckets[-1].normalize()
+        resFactor.normalize()
 
-        return buckets[-1]
+        return resFactor
         
-class FactorTree(object):
+class CachingVariableElimination(object):
+    """
+        Bucket elimination for answering many queries on the same network.
+        All queries use the same elimination order (with the query variables
+        moved to the end) and every message that is created while processing
+        a bucket is memoized. A message is the sum over the eliminated
+        variables of the product of the CPDs and evidence factors that went
+        into it, so it is keyed by the set of eliminated variables together
+        with the set of these factors, including the observed evidence
+        values. Queries that share a part of their elimination, e.g.
+        queries for different variables given the same evidence, reuse the
+        already computed messages.
+        The cache is bounded by the total number of potential entries of the
+        stored messages and the least recently used messages are dropped
+        first.
+        The network must not be modified while it is used by an instance of
+        this class, otherwise clear_cache needs to be called.
+    """
     
-    def __init__(self, tree, bn):
+    def __init__(self, bn, order=None, maxCacheSize=10**7):
+        """
+            Parameters
+            ----------
+            bn : BayesianNetwork
+                The network that is supposed to be queried.
+            order : [String,], optional
+                List containing the elimination order of all nodes of the 
+                network. If order is not given, the min degree order is used.
+            maxCacheSize : int, optional
+                Maximum number of potential entries of all cached messages
+                combined (default 10**7, i.e. 80MB).
+        """
+        self.bn = bn
+        if not order:
+            order = Orderer.get_min_degree_order(bn)
+        if sorted(order) != sorted(bn.get_all_node_names()):
+            raise ValueError("The order needs to contain each variable of " \
+                             "the network exactly once.")
+        self.order = list(order)
+        self.maxCacheSize = maxCacheSize
+        self.cacheHits = 0
+        self.cacheMisses = 0
+        self._cache = OrderedDict()
+        self._cacheSize = 0
+        self._cpdFactors = {}
+        
+    def clear_cache(self):
+        """
+            Removes all cached messages and CPD factors.
+        """
+        self._cache = OrderedDict()
+        self._cacheSize = 0
+        self._cpdFactors = {}
+        
+    @staticmethod
+    def _evidence_signature(evidence):
+        """
+            Helper function that turns the evidence for a single variable 
+            into a hashable value.
+        """
+        if isinstance(evidence, np.ndarray):
+            return tuple(evidence.tolist())
+        return evidence
+        
+    def _lookup(self, key):
+        """
+            Returns the cached message for the given key, marking it as most
+            recently used, or None.
+        """
+        message = self._cache.pop(key, None)
+        if message is None:
+            self.cacheMisses += 1
+            return None
+        self._cache[key] = message
+        self.cacheHits += 1
+        return message
+        
+    def _store(self, key, message):
+        """
+            Adds the message to the cache, dropping the least recently used
+            messages until the cache fits into maxCacheSize.
+        """
+        size = np.size(message.potentials)
+        if size > self.maxCacheSize:
+            return
+        self._cache[key] = message
+        self._cacheSize += size
+        while self._cacheSize > self.maxCacheSize:
+            _, dropped = self._cache.popitem(last=False)
+            self._cacheSize -= np.size(dropped.potentials)
+            
+    def marginals(self, variables, evidence=None):
+        """
+            Computes the joint prior or posterior marginals of the given 
+            variables, just like VariableElimination.bucket_marginals but
+            reusing the messages of previous queries wherever possible.
+            
+            Parameters
+            ----------
+            variables : [String,]
+                List containing the names of the variables whose joint prior
+                or posterior marginals are desired.
+            evidence : dict, optional
+                Dictionary containing the given evidence in the same format
+                as for VariableElimination.bucket_marginals.
+                
+            Returns
+            -------
+                Factor
+                A factor containing the desired marginals
+        """
+        if not evidence:
+            evidence = {}
+        
+        order = [v for v in self.order if v not in variables] + list(variables)
+        position = {v: i for i, v in enumerate(order)}
+        
+        #Each bucket contains the factors together with the set of 
+        #eliminated variables and the set of factors they were computed from
+        buckets = [[] for v in order]
+        for v in order:
+            if v not in self._cpdFactors:
+                self._cpdFactors[v] = Factor.from_node(self.bn.get_node(v))
+            f = self._cpdFactors[v]
+            buckets[min(position[x] for x in f.variableOrder)].append(
+                    (f, frozenset(), frozenset([v])))
+        for e in evidence:
+            f = Factor.as_evidence(e, self.bn.get_node(e).values, evidence[e])
+            signature = (e, CachingVariableElimination._evidence_signature(evidence[e]))
+            buckets[position[e]].append((f, frozenset(), frozenset([signature])))
+            
+        bucketUntil = len(order) - len(variables)
+        constants = []
+        for i in range(bucketUntil):
+            if not buckets[i]:
+                continue
+            eliminated = frozenset([order[i]]).union(*[b[1] for b in buckets[i]])
+            sources = frozenset().union(*[b[2] for b in buckets[i]])
+            key = (eliminated, sources)
+            message = self._lookup(key)
+            if message is None:
+                scope = []
+                for f, _, _ in buckets[i]:
+                    scope.extend(v for v in f.variableOrder if v not in scope)
+                scope.remove(order[i])
+                message = Factor.product_marginalize([b[0] for b in buckets[i]], scope)
+                self._store(key, message)
+            if message.variableOrder:
+                buckets[min(position[x] for x in message.variableOrder)].append(
+                        (message, eliminated, sources))
+            else:
+                constants.append(message)
+                
+        resFactor = Factor.product_marginalize(
+                [b[0] for bucket in buckets[bucketUntil:] for b in bucket] + constants,
+                list(variables))
+        resFactor.normalize()
+        return resFactor
+        
+class FactorTree(object):
+
+    def __init__(self, tree, bn, lazy=False, initialPotentials=None):
         self.tree = tree
         self.bn = bn
+        #If lazy, messages are only computed once a query requires them
+        self.lazy = lazy
+
+        #The networkx graph only describes the structure of the jointree.
+        #For propagation, the cliques are numbered in breadth first order
+        #from the root of each connected part, so that parents always come
+        #before their children and the numbering itself is the schedule of
+        #the outward pass (and its reverse the schedule of the inward pass).
+        nodeData = dict(tree.nodes(data=True))
+        self._cliqueNames = []
+        self._parent = []
+        cliqueIds = {}
+        for root in tree.nodes():
+            if root in cliqueIds:
+                continue
+            cliqueIds[root] = len(self._cliqueNames)
+            self._cliqueNames.append(root)
+            self._parent.append(-1)
+            queue = deque([root])
+            while queue:
+                node = queue.popleft()
+                for neighbor in tree.neighbors(node):
+                    if neighbor not in cliqueIds:
+                        cliqueIds[neighbor] = len(self._cliqueNames)
+                        self._cliqueNames.append(neighbor)
+                        self._parent.append(cliqueIds[node])
+                        queue.append(neighbor)
+        self._cliqueIds = cliqueIds
+        self._roots = [c for c, parent in enumerate(self._parent) if parent < 0]
+        self._cliqueFactors = [nodeData[name]["factor"] for name in self._cliqueNames]
+        self._cliqueVariables = [nodeData[name]["variables"] for name in self._cliqueNames]
+
+        #Messages are numbered per directed edge: 2k is the message of the
+        #k-th non-root clique (in schedule order) to its parent, 2k+1 the
+        #message back. Thus m^1 is always the message in opposite direction.
+        self._messages = []
+        self._messageSender = []
+        self._messageReceiver = []
+        self._messageValid = []
+        self._upMessage = [-1] * len(self._cliqueNames)
+        self._incoming = [[] for c in self._cliqueNames]
+        self._outgoing = [[] for c in self._cliqueNames]
+        for child, parent in enumerate(self._parent):
+            if parent < 0:
+                continue
+            sep = tree[self._cliqueNames[child]][self._cliqueNames[parent]]["sep"]
+            self._upMessage[child] = len(self._messages)
+            for sender, receiver in [(child, parent), (parent, child)]:
+                msgId = len(self._messages)
+                senderFactor = self._cliqueFactors[sender]
+                sepOrder = [v for v in senderFactor.variableOrder if v in sep]
+                self._messages.append(Factor.unit_factor(sepOrder,
+                        {v: senderFactor.values[v] for v in sepOrder}))
+                self._messageSender.append(sender)
+                self._messageReceiver.append(receiver)
+                self._messageValid.append(False)
+                self._outgoing[sender].append(msgId)
+                self._incoming[receiver].append(msgId)
+        #Variables that are summed out when sending each message
+        self._messageElimination = [
+                self._cliqueVariables[sender] - set(self._messages[m].variableOrder)
+                for m, sender in enumerate(self._messageSender)]
+        #For batched propagation on raw arrays: the axes of the sender that
+        #are summed out, and the permutation and shape that align each
+        #message with the axes of its receiver (both without the batch axis)
+        self._messageAxes = []
+        self._messageAlignment = []
+        for m, message in enumerate(self._messages):
+            senderOrder = self._cliqueFactors[self._messageSender[m]].variableOrder
+            self._messageAxes.append(tuple(i for i, v in enumerate(senderOrder)
+                                    if v in self._messageElimination[m]))
+            receiver = self._cliqueFactors[self._messageReceiver[m]]
+            order = message.variableOrder
+            permutation = sorted(range(len(order)),
+                                 key=lambda i: receiver.variableOrder.index(order[i]))
+            shape = tuple(len(receiver.values[v]) if v in order else 1
+                                for v in receiver.variableOrder)
+            self._messageAlignment.append((permutation, shape))
+
+        #Index of all cliques containing each variable, sorted by the size of
+        #their potential tables, so that the smallest clique for a variable
+        #can be looked up directly.
+        self._variableCliques = {}
+        for c, variables in enumerate(self._cliqueVariables):
+            for var in variables:
+                self._variableCliques.setdefault(var, []).append(c)
+        for var in self._variableCliques:
+            self._variableCliques[var].sort(
+                key=lambda c: (np.size(self._cliqueFactors[c].potentials), c))
+        #Clique each CPD of the network has been assigned to, and the
+        #clique potentials before any evidence has been set. Both are
+        #computed by reset_factors.
+        self._factorAssignment = None
+        self._initialPotentials = []
+        #Likelihoods of the currently set evidence and the clique they were
+        #applied to
+        self._evidence = {}
+        self._evidenceCliques = {}
+        if initialPotentials is None:
+            self.reset_factors()
+        else:
+            #Precompiled potentials by clique name, e.g. of a loaded jointree
+            self._initialPotentials = [initialPotentials[name]
+                                            for name in self._cliqueNames]
+            self._restore_potentials()
+
+    @staticmethod
+    def _unit_factor(bn, variables):
+        """
+            Helper function to create a factor with all potentials set to 1 
+            over the given variables of the network. Clique and separator 
+            factors are kept at their full size so that they can be updated
+            in place.
+        """
+        return Factor.unit_factor(variables, 
+                                  {v: bn.get_node(v).values for v in variables})
         
     
     @classmethod
-    def create_jointree(cls, bn, order=None):
+    def create_jointree(cls, bn, order=None, lazy=False, variables=None):
         """
             Creates a jointree according to 
             "Modeling and Reasoning with Bayesian Networks" - Adnan Darwiche
@@ -188,6 +527,22 @@ class FactorTree(object):
                 Elimination order used to create the jointree. If order is not
                 given, this algorithm computes the min degree order automatically.
                 
+            lazy : bool, optional
+                If set to True, setting evidence does not propagate any 
+                messages. Instead, each query only collects the messages 
+                towards the clique containing the queried variables, so that
+                the outward pass is only performed along the branches that 
+                later queries actually need. Default: False
+                
+            variables : [String,], optional
+                If given, the jointree is only compiled for the part of the 
+                network that is relevant for queries and evidence on these 
+                variables, i.e. without the nodes that are barren for them. 
+                The jointree then uses a pruned copy of the network, so that
+                later changes to the network's probabilities are not 
+                considered by reset_factors. Variables that are pruned are
+                skipped in the given order.
+                
             Returns
             -------
                 FactorTree
@@ -195,39 +550,50 @@ class FactorTree(object):
                 efficiently.
         """
         
+        if variables is not None:
+            bn = Pruner.get_subnetwork(bn, Pruner.get_ancestral_set(bn, variables))
+            if order:
+                order = [v for v in order if v in bn.node_lookup]
         if not order:
             order = Orderer.get_min_degree_order(bn)
-            
-        moralG = bn.graph.to_undirected()
-        factors = []
-        #Add edges between parents
-        for n in bn.get_all_nodes():
-            factors.append(Factor.from_node(n))
-            for p in n.parents:
-                for p2 in n.parents:
-                    if p != p2:
-                        moralG.add_edge(n.parents[p], n.parents[p2])
+        adjacency = Orderer._interaction_graph(bn)
+        if len(order) != len(adjacency) or set(order) != set(adjacency):
+            raise ValueError("The order needs to contain each variable of the " \
+                             "network exactly once.")
+        position = {v: i for i, v in enumerate(order)}
         
-        #Determine cluster sequence
+        #Determine cluster sequence. The parent of each cluster is the cluster
+        #of its first eliminated neighbor, which contains all other neighbors
+        #due to the fill-in edges. This elimination tree is a jointree.
         clusterSeq = []
-        for v in order:
-            variables = [v]+[n.name for n in moralG.neighbors(v)]
-            clusterSeq.append(variables)
-            moralG.remove_node(v)
-        swap= []
-        #Remove nonmaximal clusters
-        for i in range(len(clusterSeq)-1,0,-1):
-            for j in range(i-1,-1,-1):
-                if set(clusterSeq[i]).issubset(set(clusterSeq[j])):
-                    swap.append((clusterSeq[i], clusterSeq[j]))
+        separators = []
+        parents = []
+        children = [[] for v in order]
+        for i, v in enumerate(order):
+            neighbors = Orderer._eliminate(adjacency, v)
+            clusterSeq.append([v] + sorted(neighbors))
+            separators.append(neighbors)
+            if neighbors:
+                parent = min(position[n] for n in neighbors)
+                children[parent].append(i)
+                parents.append(parent)
+            else:
+                parents.append(-1)
+        
+        #Remove nonmaximal clusters: A cluster can only be contained in the
+        #cluster of one of its children j, which is the case iff the child's
+        #separator has the same size. The child then takes its place.
+        representative = list(range(len(order)))
+        for i in range(len(order)):
+            for j in children[i]:
+                if len(separators[j]) == len(clusterSeq[i]):
+                    representative[i] = j
                     break
-        #Remove cluster i and place cluster j at its location     
-        for rem, move in swap:
-            idx = clusterSeq.index(rem)
-            clusterSeq.remove(rem)
-            clusterSeq.insert(idx, move)
-            clusterSeq.remove(move)
-            
+        def find(i):
+            while representative[i] != i:
+                i = representative[i]
+            return i
+        
         # Construct jointree
         tree = nx.Graph(messagesValid=False)
         
@@ -236,65 +602,224 @@ class FactorTree(object):
         if int(nx.__version__[0]) < 2:
             tree.nodes = tree.nodes_iter
             tree.neighbors = tree.neighbors_iter
-            
         
-        if len(clusterSeq) > 0:
-            tree.add_node("".join(clusterSeq[-1]), 
-                          variables=set(clusterSeq[-1]), 
-                          factor=Factor.get_trivial())
-            for i in range(len(clusterSeq)-2,-1,-1):
-                tree.add_node("".join(clusterSeq[i]), 
-                              variables=set(clusterSeq[i]), 
-                              factor=Factor.get_trivial())
-                jointreeProp = set(clusterSeq[i]).intersection(
-                                                set().union(*clusterSeq[i+1:]))
-                for cl in clusterSeq[i+1:]:
-                    if len(jointreeProp) != 0 and  jointreeProp.issubset(set(cl)):
-                        tree.add_edge("".join(clusterSeq[i]), "".join(cl), 
-                                      sep=jointreeProp, 
-                                      factor=Factor.get_trivial())
-                        break
-                    
+        #Add the clusters starting with the roots, keeping the names unique
+        names = {}
+        for i in range(len(order)-1, -1, -1):
+            if representative[i] != i:
+                continue
+            name = "".join(clusterSeq[i])
+            suffix = 1
+            while name in tree:
+                suffix += 1
+                name = "{}#{}".format("".join(clusterSeq[i]), suffix)
+            names[i] = name
+            tree.add_node(name, variables=set(clusterSeq[i]),
+                          factor=cls._unit_factor(bn, clusterSeq[i]))
+        for i in range(len(order)-1, -1, -1):
+            if parents[i] < 0:
+                continue
+            child, parent = find(i), find(parents[i])
+            if child != parent:
+                tree.add_edge(names[child], names[parent], sep=set(separators[i]))
                     
-        # Assign factors to clusters
-        for f in factors:
-            for treeNode, treeData in tree.nodes(data=True): #was nodes_iter in networkx 1.x
-                if set(f.values).issubset(treeData["variables"]):
-                    treeData["factor"] = treeData["factor"] * f
-                    break
-        return cls(tree,bn)
+        return cls(tree,bn,lazy=lazy)
+
+    def save(self, path):
+        """
+            Saves the compiled jointree, i.e. its cliques, separators and 
+            initial potentials, to an uncompressed .npz archive, so that it
+            can be loaded without the BayesianNetwork and without recomputing
+            the elimination order, the jointree and the potentials. Evidence
+            is not saved.
+            
+            Parameters
+            ----------
+            path : String
+                Path of the file to be written. Unlike np.savez, no ".npz" is
+                appended.
+        """
+        values = {}
+        for factor in self._cliqueFactors:
+            for v in factor.variableOrder:
+                values[v] = list(factor.values[v])
+        metadata = {"version": 1,
+                    "lazy": self.lazy,
+                    "cliques": [{"name": name, "variables": factor.variableOrder}
+                        for name, factor in zip(self._cliqueNames, self._cliqueFactors)],
+                    "values": values,
+                    "edges": [[self._cliqueNames[child], self._cliqueNames[parent],
+                               sorted(self._cliqueVariables[child] &
+                                      self._cliqueVariables[parent])]
+                        for child, parent in enumerate(self._parent) if parent >= 0],
+                    "factorAssignment": None if self._factorAssignment is None else
+                        {n: self._cliqueNames[c] for n, c in self._factorAssignment.items()}}
+        arrays = {"clique{}".format(c): potentials
+                        for c, potentials in enumerate(self._initialPotentials)}
+        with open(path, "wb") as f:
+            np.savez(f, metadata=np.array(json.dumps(metadata)), **arrays)
+
+    @classmethod
+    def load(cls, path, bn=None, mmap=True, lazy=None):
+        """
+            Loads a jointree that was saved with save. 
+            
+            Parameters
+            ----------
+            path : String
+                Path of the saved jointree.
+            bn : BayesianNetwork, optional
+                The network the jointree was created for. It is only required
+                to recompute the potentials with reset_factors after the
+                network's probabilities changed.
+            mmap : bool, optional
+                If set to True (default), the initial potentials are memory
+                mapped read-only instead of being read into memory, so that 
+                multiple processes share them via the page cache.
+            lazy : bool, optional
+                Overwrites whether the loaded tree propagates lazily. Defaults
+                to the setting of the saved tree.
+                
+            Returns
+            -------
+                FactorTree
+                The loaded jointree.
+        """
+        with np.load(path) as data:
+            metadata = json.loads(str(data["metadata"]))
+            if not mmap:
+                arrays = {"clique{}".format(c): data["clique{}".format(c)]
+                                for c in range(len(metadata["cliques"]))}
+        if mmap:
+            arrays = _memory_map_npz(path)
+        
+        tree = nx.Graph(messagesValid=False)
+        #Monkey patch networkx 1.x versions to still user iterator functions:
+        if int(nx.__version__[0]) < 2:
+            tree.nodes = tree.nodes_iter
+            tree.neighbors = tree.neighbors_iter
+        values = metadata["values"]
+        initialPotentials = {}
+        for c, clique in enumerate(metadata["cliques"]):
+            variables = clique["variables"]
+            tree.add_node(clique["name"], variables=set(variables),
+                          factor=Factor.unit_factor(variables, 
+                                            {v: values[v] for v in variables}))
+            initialPotentials[clique["name"]] = arrays["clique{}".format(c)]
+        for child, parent, sep in metadata["edges"]:
+            tree.add_edge(child, parent, sep=set(sep))
+        
+        res = cls(tree, bn, lazy=metadata["lazy"] if lazy is None else lazy,
+                  initialPotentials=initialPotentials)
+        if metadata["factorAssignment"] is not None:
+            res._factorAssignment = {n: res._cliqueIds[name] 
+                            for n, name in metadata["factorAssignment"].items()}
+        return res
         
 
     def reset_factors(self):
         """
-            Resets all the factors in the jointree to the standards given by the
-            BayesianNetwork. This is necessary when the evidence changes, or maybe
-            some probabilities changed within the BayesianNetwork.
-        """        
-        
-        #Create new factors
-        factors = []
+            Recomputes the initial clique potentials of the jointree from the
+            factors given by the BayesianNetwork and resets all factors to
+            them. This is only necessary when some probabilities changed within
+            the BayesianNetwork, as set_evidence restores the cached initial
+            potentials itself.
+        """
+        if self.bn is None:
+            raise ValueError("The potentials of a jointree without its " \
+                             "BayesianNetwork cannot be recomputed.")
+        if self._factorAssignment is None:
+            # Assign each CPD to the smallest clique containing its family
+            self._factorAssignment = {}
+            for n in self.bn.get_all_nodes():
+                try:
+                    self._factorAssignment[n.name] = self._find_clique(
+                                                    [n.name] + n.parentOrder)
+                except ValueError:
+                    raise ValueError("No clique containing the family of {} " \
+                                     "was found.".format(n.name))
+
+        for factor in self._cliqueFactors:
+            factor.potentials.fill(1.0)
         for n in self.bn.get_all_nodes():
-            factors.append(Factor.from_node(n))
-        #Reset factors in nodes and edges of the tree
-        for treeNode, treeData in self.tree.nodes(data=True): #was nodes_iter in networkx 1.x
-            treeData["factor"] = Factor.get_trivial()
-        for u,b, edgeData in self.tree.edges(data=True): # was edges_iter
-            edgeData["factor"] = Factor.get_trivial()
-            
-        for f in factors:
-            for treeNode, treeData in self.tree.nodes(data=True): #was nodes_iter in networkx 1.x
-                if set(f.values).issubset(treeData["variables"]):
-                    treeData["factor"] = treeData["factor"] * f
-                    break
+            self._cliqueFactors[self._factorAssignment[n.name]] *= Factor.from_node(n)
+        self._initialPotentials = [np.copy(factor.potentials)
+                                        for factor in self._cliqueFactors]
+        self._evidence = {}
+        self._evidenceCliques = {}
+        self._restore_potentials()
+
+    def _restore_potentials(self):
+        """
+            Copies the cached initial potentials back into the clique factors
+            and invalidates all messages.
+        """
+        for factor, initial in zip(self._cliqueFactors, self._initialPotentials):
+            np.copyto(factor.potentials, initial)
+        self._messageValid = [False] * len(self._messages)
         self.tree.graph["messagesValid"] = False
-        
-        
+
+    def _reset_clique(self, clique):
+        """
+            Restores the initial potentials of a single clique and applies the
+            evidence that is currently set on any of its variables.
+        """
+        factor = self._cliqueFactors[clique]
+        np.copyto(factor.potentials, self._initialPotentials[clique])
+        for e, evidenceClique in self._evidenceCliques.items():
+            if evidenceClique == clique:
+                self._apply_evidence(factor, e, self._evidence[e])
+
+    def _apply_evidence(self, factor, variable, likelihoods):
+        """
+            Multiplies the likelihoods of the given evidence into the given
+            clique factor in place by scaling the variable's axis. For hard
+            evidence, the likelihoods are an index mask of the observed value.
+        """
+        shape = [1] * len(factor.variableOrder)
+        shape[factor.variableOrder.index(variable)] = len(likelihoods)
+        factor.potentials *= np.reshape(likelihoods, shape)
+
+    def _variable_values(self, variable):
+        """
+            Returns the list of values of the given variable, which is taken
+            from the cliques so that no BayesianNetwork is required.
+        """
+        return list(self._cliqueFactors[self._find_clique(variable)].values[variable])
+
+    def _find_clique(self, variables):
+        """
+            Returns the smallest clique containing all the given variables,
+            using the variable index of the tree.
+
+            Parameters
+            ----------
+            variables : String or [String,]
+                A single variable or a list of variables.
+
+            Returns
+            -------
+                int
+                The number of the clique.
+        """
+        if not isinstance(variables, (list, set, tuple)):
+            return self._variableCliques[variables][0]
+        variables = list(variables)
+        try:
+            for clique in self._variableCliques[variables[0]]:
+                if self._cliqueVariables[clique].issuperset(variables):
+                    return clique
+        except (KeyError, IndexError):
+            pass
+        raise ValueError("No clique containing the variables {} was found."
+                         .format(variables))
+
     def set_evidence(self, evidence, softPosteriors=False):
         """
-            Sets the given evidence in the factor tree. This will trigger a 
-            recomputation of the messages given this evidence.
-            
+            Sets the given evidence in the factor tree. Unless the tree is lazy,
+            this will trigger a recomputation of the messages given this
+            evidence.
+
             Parameters
             ----------
             evidence : dict
@@ -303,48 +828,109 @@ class FactorTree(object):
                 be simple strings of the given values, or a np.array specifying
                 the strength of the evidence for each outcome, e.g.:
                 For the binary evidence node E
-                evidence = {"E": "True"} is equivalent to 
+                evidence = {"E": "True"} is equivalent to
                 {"E": np.array([1.0,0.0])}
+                Changes to the probabilities of the BayesianNetwork are only
+                considered after calling reset_factors.
             softPosteriors: bool, optional
                 If softPosterior is set to True, the evidence, should it be a
-                np.array, is interpreted as soft evidence for a desired 
+                np.array, is interpreted as soft evidence for a desired
                 posterior distribution. For this, the naive marginals for all
                 evidence variables need to be computed first before the
                 likelihood ratio factor can be computed. If softPosterior is
                 not set, any potential soft evidence is considered as likelihood
                 ratio directly.
         """
-        self.reset_factors()
+        self._evidence = {}
+        self._evidenceCliques = {}
+        self._restore_potentials()
         #Initialice temporary marginals to None
         oldMarginals = {e: None for e in evidence}
         if softPosteriors:
             #Compute the old/naive marignals for the evidence values which are
             #required to compute the proper likelihood ratio factor below
-            self.calculate_messages()
             for e in evidence:
                 oldMarginals[e] = self.marginals([e]).potentials
-            self.reset_factors()
-        
+            self._messageValid = [False] * len(self._messages)
+
         # Add evidence to buckets
         for e in evidence:
-            evidenceFactor = Factor.as_evidence(e, 
-                                    self.bn.get_node(e).values, 
+            evidenceFactor = Factor.as_evidence(e,
+                                    self._variable_values(e),
                                     evidence[e], oldMarginals=oldMarginals[e])
-            for node, nodeData in self.tree.nodes(data=True): #was nodes_iter in networkx 1.x
-                if e in nodeData["variables"]:
-                    nodeData["factor"] = nodeData["factor"] * evidenceFactor
-                    break
-        self.calculate_messages()
-        
+            clique = self._find_clique(e)
+            self._evidence[e] = evidenceFactor.potentials
+            self._evidenceCliques[e] = clique
+            self._apply_evidence(self._cliqueFactors[clique], e,
+                                 evidenceFactor.potentials)
+        if not self.lazy:
+            self.calculate_messages()
+
+    def update_evidence(self, delta):
+        """
+            Incrementally changes the evidence that is currently set in the
+            factor tree. Only the cliques containing changed evidence variables
+            are reset and only the messages that depend on these cliques are
+            invalidated. These messages are not recomputed right away, but
+            only once a query requires them, so that a change of evidence
+            costs an update along the path to the queried clique instead of
+            a full propagation.
+
+            Parameters
+            ----------
+            delta : dict
+                Dictionary containing the changed evidence in the same format
+                as for set_evidence. Soft evidence is interpreted as likelihood
+                ratio. A value of None retracts the evidence for that variable.
+        """
+        changedCliques = set()
+        for e in delta:
+            if delta[e] is None:
+                if e not in self._evidence:
+                    continue
+                del self._evidence[e]
+                changedCliques.add(self._evidenceCliques.pop(e))
+            else:
+                evidenceFactor = Factor.as_evidence(e,
+                                        self._variable_values(e), delta[e])
+                clique = self._find_clique(e)
+                self._evidence[e] = evidenceFactor.potentials
+                self._evidenceCliques[e] = clique
+                changedCliques.add(clique)
+
+        for clique in changedCliques:
+            self._reset_clique(clique)
+            self._invalidate_messages(clique)
+
+    def _invalidate_messages(self, clique):
+        """
+            Invalidates all messages that depend on the potentials of the
+            given clique, i.e. all messages directed away from it. Since a
+            message can only be valid if all messages it depends on are
+            valid, the search can stop at messages that are already invalid.
+        """
+        valid = self._messageValid
+        stack = list(self._outgoing[clique])
+        while stack:
+            msgId = stack.pop()
+            if valid[msgId]:
+                valid[msgId] = False
+                reverse = msgId ^ 1
+                stack.extend(m for m in self._outgoing[self._messageReceiver[msgId]]
+                                if m != reverse)
+        self.tree.graph["messagesValid"] = False
+
     def marginals(self, variables):
         """
             Function to compute marginals for the given variables, potentially
             given some evidence that was set beforehand using set_evidence.
-            The marginals can be computed efficiently using the Hugin
-            architecture (see "Modeling and Reasoning with Bayesian Networks" - 
-            Adnan Darwiche Chapter 7 and especially 7.7.4)
+            The marginals can be computed efficiently using the Shafer-Shenoy
+            architecture (see "Modeling and Reasoning with Bayesian Networks" -
+            Adnan Darwiche Chapter 7 and especially 7.7.3). Only messages
+            towards the clique containing the variables that are not valid
+            anymore are recomputed.
+
 
-            
             Parameters
             ----------
             variables : [String,]
@@ -354,84 +940,401 @@ class FactorTree(object):
                 if they are contained in any clique. To compute the joint
                 marginals for a fixed instantiation, this instantiation can
                 be set as evidence and its probability can be queried using
-                get_evidence_probability()                
-                
+                get_evidence_probability()
+
             Returns
             -------
                 Factor
                 A factor containing the desired marginals
         """
-        if not self.tree.graph["messagesValid"]:
-            self.calculate_messages()
-            
-        # Determine clique containing variables:
-        varSet = set(variables)
-        for treeNode, treeData in self.tree.nodes(data=True): #was nodes_iter in networkx 1.x
-            if varSet.issubset(treeData["variables"]):
-                resFactor = treeData["factor"].marginalize(treeData["variables"] - varSet)
-                resFactor.normalize()
-                return resFactor
-        else:
-            # No suitable clique found
-            raise ValueError("No clique containing the variables {} was found.".format(variables))
-            
-        
-    def get_evidence_probability(self):
-         raise NotImplementedError("We still need to implement this...")
-        
+        # Determine smallest clique containing variables:
+        clique = self._find_clique(variables)
+        resFactor = self._clique_belief(clique)
+        resFactor = resFactor.marginalize(self._cliqueVariables[clique] - set(variables))
+        resFactor.normalize()
+        return resFactor
+
+    def all_marginals(self, packed=False):
+        """
+            Computes the posterior marginals of every variable of the jointree
+            in one call, given the evidence that was set beforehand using
+            set_evidence. After a single full propagation, the belief of each
+            clique that is the smallest clique of some variable is computed
+            once and the marginals of all these variables are obtained by 
+            summing over the belief's other axes.
+
+            Parameters
+            ----------
+            packed : bool, optional
+                If set to True, the marginals are returned as a single 2D
+                array instead of a dictionary (default False).
+
+            Returns
+            -------
+                dict or ([String,], np.array)
+                Dictionary mapping each variable name to a np.array
+                containing its marginals. If packed is True, a list of the
+                variable names in sorted order is returned together with a
+                (variables x maximum number of states) np.array, whose rows
+                contain the marginals of the variable with the same index,
+                padded with zeros.
+        """
+        self.calculate_messages()
+        ownedVariables = {}
+        for var, cliques in self._variableCliques.items():
+            ownedVariables.setdefault(cliques[0], []).append(var)
+        res = {}
+        for clique, variables in ownedVariables.items():
+            factor = self._cliqueFactors[clique]
+            belief = Factor.product_marginalize(
+                    [factor] + [self._messages[m] for m in self._incoming[clique]],
+                    factor.variableOrder).potentials
+            total = np.sum(belief)
+            if total > 0:
+                belief = belief / total
+            allAxes = set(range(belief.ndim))
+            for var in variables:
+                axis = factor.variableOrder.index(var)
+                res[var] = np.sum(belief, axis=tuple(allAxes - set([axis])))
+        if not packed:
+            return res
+        names = sorted(res)
+        array = np.zeros((len(names), max([len(res[var]) for var in names] + [0])))
+        for i, var in enumerate(names):
+            array[i, :len(res[var])] = res[var]
+        return names, array
+
+    def batch_marginals(self, variables, evidenceTable, chunkSize=1000):
+        """
+            Computes the posterior marginals of the given variables for many
+            evidence cases at once. Instead of setting the evidence of each
+            case separately, all clique potentials and messages carry a leading
+            batch axis, so that the cases are propagated through the jointree
+            together in one set of numpy operations. The evidence currently set
+            with set_evidence is not considered and remains unchanged.
+
+            Parameters
+            ----------
+            variables : [String,]
+                List containing the names of the variables whose posterior
+                marginals are desired.
+            evidenceTable : [dict,] or dict
+                Either a list of evidence dictionaries, one per case, in the
+                same format as for set_evidence, or a dictionary mapping
+                variable names to sequences containing one observation per
+                case. Observations can be value strings for hard evidence or
+                np.arrays which are interpreted as likelihood ratio. Missing
+                variables or None values mean that the variable was not
+                observed in that case.
+            chunkSize : int, optional
+                The maximum number of cases that are propagated together.
+                Bounds the memory required for the batched potentials
+                (default 1000).
+
+            Returns
+            -------
+                dict
+                Dictionary mapping each variable name to an (N x states)
+                np.array containing the posterior marginals for each of the N
+                cases. Cases with impossible evidence have all zero rows.
+        """
+        columns, numCases = self._evidence_columns(evidenceTable)
+        queryCliques = [self._find_clique(var) for var in variables]
+        res = {var: np.zeros((numCases, len(self._cliqueFactors[c].values[var])))
+                    for var, c in zip(variables, queryCliques)}
+        for start in range(0, numCases, chunkSize):
+            stop = min(start + chunkSize, numCases)
+            potentials, messages, logScales = self._batch_propagate(
+                    {var: column[start:stop] for var, column in columns.items()},
+                    stop - start)
+            for var, clique in zip(variables, queryCliques):
+                belief, logScale = self._batch_belief(clique, potentials,
+                                                      messages, logScales)
+                order = self._cliqueFactors[clique].variableOrder
+                marginals = np.sum(belief, axis=tuple(i+1 for i, v in enumerate(order)
+                                                        if v != var))
+                # Cliques without any evidence in their part of the tree
+                # only have a batch axis of size 1
+                marginals = np.broadcast_to(marginals, res[var][start:stop].shape)
+                total = np.sum(marginals, axis=1, keepdims=True)
+                np.divide(marginals, total, out=res[var][start:stop],
+                          where=total > 0)
+        return res
+
+    @staticmethod
+    def _evidence_columns(evidenceTable):
+        """
+            Converts the given evidence table into a dictionary of columns
+            with one entry per case.
+
+            Returns
+            -------
+                dict, int
+                The dictionary of columns and the number of cases.
+        """
+        if isinstance(evidenceTable, dict):
+            lengths = set(len(column) for column in evidenceTable.values())
+            if len(lengths) > 1:
+                raise ValueError("All evidence columns need to contain the " \
+                                 "same number of cases.")
+            return evidenceTable, lengths.pop() if lengths else 0
+        variables = set()
+        for row in evidenceTable:
+            variables.update(row)
+        return {var: [row.get(var) for row in evidenceTable] for var in variables}, \
+                len(evidenceTable)
+
+    def _batch_likelihoods(self, variable, column):
+        """
+            Creates a (cases x states) array containing the likelihoods of
+            the given evidence column. Unobserved cases have all ones.
+        """
+        values = self._cliqueFactors[self._find_clique(variable)].values[variable]
+        likelihoods = np.ones((len(column), len(values)))
+        for i, evidence in enumerate(column):
+            if evidence is None:
+                continue
+            if isinstance(evidence, np.ndarray):
+                if len(evidence) != len(values):
+                    raise ValueError("The number of evidence strength ({}) " \
+                                "does not correspont to the number of values ({})"
+                                .format(len(evidence), len(values)))
+                likelihoods[i] = evidence
+            else:
+                if not evidence in values:
+                    raise ValueError("Evidence {} is not one of the possible " \
+                                     "values ({}) for this variable."
+                                     .format(evidence, values))
+                likelihoods[i] = 0.0
+                likelihoods[i, values.index(evidence)] = 1.0
+        return likelihoods
+
+    def _batch_propagate(self, columns, numCases, outward=True):
+        """
+            Performs the inward and (optionally) outward pass for a batch of
+            evidence cases on raw arrays with a leading batch axis. Each
+            message is rescaled per case to sum to 1 and the logarithms of
+            the removed constants are kept alongside.
+
+            Returns
+            -------
+                [np.array,], [np.array,], [np.array,]
+                The batched clique potentials, messages and message log scales,
+                indexed by clique and message number. Arrays that do not depend
+                on any evidence have a batch axis of size 1.
+        """
+        potentials = [initial[np.newaxis] for initial in self._initialPotentials]
+        for var, column in columns.items():
+            clique = self._find_clique(var)
+            order = self._cliqueFactors[clique].variableOrder
+            shape = [numCases] + [1] * len(order)
+            shape[order.index(var) + 1] = -1
+            potentials[clique] = potentials[clique] * np.reshape(
+                                    self._batch_likelihoods(var, column), shape)
+
+        messages = [None] * len(self._messages)
+        logScales = [None] * len(self._messages)
+        numCliques = len(self._cliqueNames)
+        for child in range(numCliques-1, -1, -1):
+            if self._upMessage[child] >= 0:
+                self._batch_send(self._upMessage[child], potentials, messages,
+                                 logScales)
+        if outward:
+            for child in range(numCliques):
+                if self._upMessage[child] >= 0:
+                    self._batch_send(self._upMessage[child] ^ 1, potentials,
+                                     messages, logScales)
+        return potentials, messages, logScales
+
+    def _batch_aligned(self, msgId, messages):
+        """
+            Returns the batched message with its axes aligned to the axes of
+            its receiver, so that it can be broadcast against its potentials.
+        """
+        permutation, shape = self._messageAlignment[msgId]
+        message = messages[msgId]
+        message = np.transpose(message, [0] + [i+1 for i in permutation])
+        return np.reshape(message, (message.shape[0],) + shape)
+
+    def _batch_belief(self, clique, potentials, messages, logScales, exclude=-1):
+        """
+            Multiplies the batched potentials of the given clique with all
+            its incoming batched messages apart from the excluded one.
+
+            Returns
+            -------
+                np.array, np.array
+                The batched product and the sum of the log scales of the
+                multiplied messages per case.
+        """
+        belief = potentials[clique]
+        logScale = np.zeros(1)
+        for msgId in self._incoming[clique]:
+            if msgId != exclude:
+                belief = belief * self._batch_aligned(msgId, messages)
+                logScale = logScale + logScales[msgId]
+        return belief, logScale
+
+    def _batch_send(self, msgId, potentials, messages, logScales):
+        """
+            Computes the given batched message from the batched potentials and
+            the other incoming messages of its sender and rescales it per case.
+        """
+        product, logScale = self._batch_belief(self._messageSender[msgId],
+                                    potentials, messages, logScales,
+                                    exclude=msgId ^ 1)
+        message = np.sum(product, axis=tuple(i+1 for i in self._messageAxes[msgId]))
+        total = np.sum(np.reshape(message, (message.shape[0], -1)), axis=1)
+        totalShape = (-1,) + (1,) * (message.ndim - 1)
+        messages[msgId] = np.divide(message, np.reshape(total, totalShape),
+                                    out=np.zeros(message.shape),
+                                    where=np.reshape(total, totalShape) > 0)
+        with np.errstate(divide="ignore"):
+            logScales[msgId] = logScale + np.log(total)
+
+    def log_likelihood(self, evidenceTable, chunkSize=1000):
+        """
+            Computes the log probability of the evidence of many cases at
+            once. Only the inward pass of the batched propagation is performed
+            and the probability of each case is read off the roots of the
+            jointree, as for get_evidence_probability. The evidence currently
+            set with set_evidence is not considered and remains unchanged.
+
+            Parameters
+            ----------
+            evidenceTable : [dict,] or dict
+                The evidence of all cases in the same format as for
+                batch_marginals.
+            chunkSize : int, optional
+                The maximum number of cases that are propagated together
+                (default 1000).
+
+            Returns
+            -------
+                np.array
+                The natural logarithm of the probability of the evidence of
+                each case. Impossible evidence results in -inf.
+        """
+        columns, numCases = self._evidence_columns(evidenceTable)
+        res = np.zeros(numCases)
+        for start in range(0, numCases, chunkSize):
+            stop = min(start + chunkSize, numCases)
+            potentials, messages, logScales = self._batch_propagate(
+                    {var: column[start:stop] for var, column in columns.items()},
+                    stop - start, outward=False)
+            for root in self._roots:
+                belief, logScale = self._batch_belief(root, potentials,
+                                                      messages, logScales)
+                total = np.sum(np.reshape(belief, (belief.shape[0], -1)), axis=1)
+                with np.errstate(divide="ignore"):
+                    res[start:stop] += logScale + np.log(total)
+        return res
+
+    def get_evidence_probability(self, logarithm=False):
+        """
+            Returns the probability of the evidence that is currently set.
+            Since the messages keep track of the constants they were scaled
+            with, the probability is obtained from the beliefs of the root
+            of each connected part of the jointree, which only requires the
+            messages of the collect pass towards these roots. 
+
+            Parameters
+            ----------
+            logarithm : bool, optional
+                If set to True, the natural logarithm of the probability is
+                returned instead, which is not affected by underflows even
+                for very unlikely evidence.
+
+            Returns
+            -------
+                float
+                The (log) probability of the evidence.
+        """
+        logProbability = 0.0
+        for root in self._roots:
+            logProbability += self._clique_belief(root).get_log_sum()
+        if logarithm:
+            return logProbability
+        return np.exp(logProbability)
+
+    def _clique_belief(self, clique):
+        """
+            Computes the product of the given clique's potentials with all its
+            incoming messages, collecting any messages that are not valid.
+
+            Parameters
+            ----------
+            clique : int
+                Number of the clique within the jointree.
+
+            Returns
+            -------
+                Factor
+                A new factor over the clique's variables.
+        """
+        self._collect(clique)
+        belief = self._cliqueFactors[clique].copy()
+        for msgId in self._incoming[clique]:
+            belief *= self._messages[msgId]
+        return belief
+
     def calculate_messages(self):
         """
-            Performs the two way (inward and outward) message passing with
-            the first node as root. Is needed to validate the messages in the
-            jointree.
+            Performs the two way (inward and outward) message passing for
+            each connected part of the jointree by following the precomputed
+            schedule. Only messages which are not valid anymore are recomputed.
         """
-        try:
-            root = list(self.tree.nodes())[0]
-            self.pull_messages(self.tree, root, None)
-            self.push_messages(self.tree, root, None)
-            self.tree.graph["messagesValid"] = True
-        except IndexError:
-            pass
-        
+        valid = self._messageValid
+        numCliques = len(self._cliqueNames)
+        #Inward pass: children send to their parents, leaves first
+        for child in range(numCliques-1, -1, -1):
+            msgId = self._upMessage[child]
+            if msgId >= 0 and not valid[msgId]:
+                self._send_message(msgId)
+        #Outward pass: parents send to their children, roots first
+        for child in range(numCliques):
+            msgId = self._upMessage[child]
+            if msgId >= 0 and not valid[msgId ^ 1]:
+                self._send_message(msgId ^ 1)
+        self.tree.graph["messagesValid"] = True
+
     def pull_messages(self, tree, curNode, parent):
         """
             Performs the inward message passing from the given node to its
-            parent according to Hugin's architecture.
-            
+            parent, i.e. makes sure that all messages in the subtree of curNode
+            directed towards the parent are valid.
+
             Parameters
             ----------
             tree : nx.Graph
-                The underlying jointree. Is only passed as parameter for slight
-                performance improvements.
+                The underlying jointree. Only kept for backwards compatibility.
             curNode : String
                 Name of the clique node within the jointree that should currently
                 send it's message to the given parent.
             parent : String
                 Name of the parent node the message should be passed to.
         """
-        #Let neighbors collect messages
-        for neighbor in tree.neighbors(curNode): #was neighbors_iter in networkx 1.x
-            if neighbor != parent:
-                self.pull_messages(tree, neighbor, curNode)
-                      
-        # Send message to parent
-        if parent:
-            newSeqFactor = tree.node[curNode]["factor"].marginalize(tree.node[curNode]["variables"]-tree[curNode][parent]["sep"])
-            tree.node[parent]["factor"] = tree.node[parent]["factor"] * (newSeqFactor / tree[curNode][parent]["factor"])
-            tree[curNode][parent]["factor"] = newSeqFactor
-        else:
+        clique = self._cliqueIds[curNode]
+        if not parent:
+            self._collect(clique)
             return
-            
+        parentClique = self._cliqueIds[parent]
+        for msgId in self._outgoing[clique]:
+            if self._messageReceiver[msgId] == parentClique:
+                self._collect(clique, msgId ^ 1)
+                if not self._messageValid[msgId]:
+                    self._send_message(msgId)
+
     def push_messages(self, tree, curNode, parent):
         """
             Performs the outwards message passing from the given node to its
-            children other than the given parent according to Hugin's architecture.
-            
+            children other than the given parent. Requires the messages
+            towards curNode to be valid.
+
             Parameters
             ----------
             tree : nx.Graph
-                The underlying jointree. Is only passed as parameter for slight
-                performance improvements.
+                The underlying jointree. Only kept for backwards compatibility.
             curNode : String
                 Name of the clique node within the jointree that should currently
                 send it's message to it's children
@@ -439,13 +1342,67 @@ class FactorTree(object):
                 Name of the parent node to avoid sending messages back to the
                 parent.
         """
-        for neighbor in tree.neighbors(curNode): #was neighbors_iter in networkx 1.x
-            if neighbor != parent:
-                #Send message out to neighbor
-                newSeqFactor = tree.node[curNode]["factor"].marginalize(tree.node[curNode]["variables"]-tree[curNode][neighbor]["sep"])
-                tree.node[neighbor]["factor"] = tree.node[neighbor]["factor"] * (newSeqFactor / tree[curNode][neighbor]["factor"])
-                tree[curNode][neighbor]["factor"] = newSeqFactor
-                # Have neighbor pushing out further
-                self.push_messages(tree, neighbor, curNode)
-            
-        
+        parentClique = self._cliqueIds[parent] if parent else -1
+        stack = [m for m in self._outgoing[self._cliqueIds[curNode]]
+                    if self._messageReceiver[m] != parentClique]
+        while stack:
+            msgId = stack.pop()
+            if not self._messageValid[msgId]:
+                self._send_message(msgId)
+            stack.extend(m for m in self._outgoing[self._messageReceiver[msgId]]
+                            if m != msgId ^ 1)
+
+    def _collect(self, clique, exclude=-1):
+        """
+            Makes sure that all messages towards the given clique (apart from
+            the given excluded message) are valid by recomputing the invalid
+            ones, starting at the leaves. Subtrees whose messages are still
+            valid are not visited.
+
+            Parameters
+            ----------
+            clique : int
+                Number of the clique that messages are collected to.
+            exclude : int, optional
+                Number of an incoming message that is not required.
+        """
+        valid = self._messageValid
+        # Determine the invalid messages in breadth first order from the
+        # clique and compute them in reverse order
+        pending = [m for m in self._incoming[clique] if m != exclude and not valid[m]]
+        i = 0
+        while i < len(pending):
+            msgId = pending[i]
+            reverse = msgId ^ 1
+            for m in self._incoming[self._messageSender[msgId]]:
+                if m != reverse and not valid[m]:
+                    pending.append(m)
+            i += 1
+        for msgId in reversed(pending):
+            self._send_message(msgId)
+
+    def _send_message(self, msgId):
+        """
+            Computes the given message by multiplying the sender's potentials
+            with all its other incoming messages and summing out the variables
+            not in their separator. The product is never built explicitly,
+            instead the message is contracted directly into its existing
+            potentials by Factor.product_marginalize. The potentials are 
+            rescaled to sum to 1 while their logScale keeps track of the 
+            removed constant. All other incoming messages of the sender need
+            to be valid.
+
+            Parameters
+            ----------
+            msgId : int
+                Number of the directed message.
+        """
+        sender = self._messageSender[msgId]
+        reverse = msgId ^ 1
+        factors = [self._cliqueFactors[sender]] + [self._messages[m]
+                        for m in self._incoming[sender] if m != reverse]
+        message = self._messages[msgId]
+        Factor.product_marginalize(factors, message.variableOrder, out=message)
+        # Keep the message in a safe range to avoid underflows in large trees
+        self._messages[msgId].rescale()
+        self._messageValid[msgId] = True
@@ -21,10 +21,214 @@
 
 from __future__ import division
 
+from collections import namedtuple
+import itertools
+import operator
+
 import numpy as np
 
 from ..nodes import DiscreteNode, RandomNode, UtilityNode
 
+# Broadcast plans are cached for each pair of variable orders that has been
+# combined before, so that repeated products within the same network do not 
+# need to recompute how the dimensions of both operands have to be aligned.
+_BroadcastPlan = namedtuple("_BroadcastPlan", ["variableOrder", 
+                                               "extraVariables", 
+                                               "lhsPadding", 
+                                               "rhsPadding", 
+                                               "rhsAxes"])
+_broadcastPlans = {}
+MAX_CACHED_PLANS = 100000
+
+def _get_broadcast_plan(lhsOrder, rhsOrder):
+    """
+        Returns the (cached) plan describing how the potentials of two factors
+        with the given variable orders need to be reshaped and transposed so
+        that numpy can broadcast them onto each other. The resulting order
+        is the left-hand order extended by the new variables of the right-hand
+        order.
+        
+        Parameters
+        ----------
+        lhsOrder : [String,]
+            The variable order of the left operand.
+        rhsOrder : [String,]
+            The variable order of the right operand.
+            
+        Returns
+        -------
+            _BroadcastPlan
+            The plan for this combination of variable orders.
+    """
+    key = (tuple(lhsOrder), tuple(rhsOrder))
+    try:
+        return _broadcastPlans[key]
+    except KeyError:
+        pass
+    
+    lhsSet = set(lhsOrder)
+    extraVariables = tuple(v for v in rhsOrder if v not in lhsSet)
+    variableOrder = key[0] + extraVariables
+    rhsSet = set(rhsOrder)
+    extendedRhs = list(rhsOrder) + [v for v in variableOrder if v not in rhsSet]
+    rhsAxes = tuple(extendedRhs.index(v) for v in variableOrder)
+    if rhsAxes == tuple(range(len(rhsAxes))):
+        rhsAxes = None
+    plan = _BroadcastPlan(variableOrder, extraVariables, 
+                          (1,) * len(extraVariables),
+                          (1,) * (len(variableOrder) - len(rhsOrder)),
+                          rhsAxes)
+    if len(_broadcastPlans) >= MAX_CACHED_PLANS:
+        _broadcastPlans.clear()
+    _broadcastPlans[key] = plan
+    return plan
+    
+def _safe_divide(dividend, divisor):
+    """
+        Pointwise division of two broadcastable arrays which defines x/0 = 0,
+        analogous to Factor.invert.
+    """
+    res = np.zeros(np.broadcast(dividend, divisor).shape)
+    np.divide(dividend, divisor, out=res, where=(divisor != 0))
+    return res
+
+# Contraction plans of np.einsum are cached for each combination of variable
+# orders, shapes and kept variables of product_marginalize.
+_einsumPlans = {}
+# np.einsum only supports 52 different subscripts
+MAX_EINSUM_VARIABLES = 52
+
+def _get_einsum_plan(operands, key):
+    """
+        Returns the (cached) contraction plan for the given einsum operands in
+        sublist format. The plan is the optimized path of np.einsum_path as a
+        list of pairwise (or single) contraction steps, each consisting of
+        the positions of the contracted operands and the subscripts of the
+        intermediate result, which is appended to the operands.
+        Executing the steps directly avoids the considerable overhead of
+        np.einsum re-evaluating the path on every call.
+    """
+    try:
+        return _einsumPlans[key]
+    except KeyError:
+        pass
+    subscripts = list(operands[1:-1:2])
+    output = operands[-1]
+    if len(set(output).union(*subscripts)) > MAX_EINSUM_VARIABLES:
+        sizes = {}
+        for array, sub in zip(operands[0:-1:2], subscripts):
+            sizes.update(zip(sub, np.shape(array)))
+        path = _greedy_einsum_path(subscripts, output, sizes)
+    else:
+        path = np.einsum_path(*operands, optimize="greedy")[0][1:]
+    plan = []
+    for positions in path:
+        positions = tuple(sorted(positions, reverse=True))
+        contracted = [subscripts.pop(p) for p in positions]
+        if not subscripts:
+            result = list(output)
+        else:
+            needed = set(output)
+            for sub in subscripts:
+                needed.update(sub)
+            result = []
+            for sub in contracted:
+                result.extend(i for i in sub if i in needed and i not in result)
+        subscripts.append(result)
+        plan.append((positions, result))
+    if len(_einsumPlans) >= MAX_CACHED_PLANS:
+        _einsumPlans.clear()
+    _einsumPlans[key] = plan
+    return plan
+
+def _greedy_einsum_path(subscripts, output, sizes):
+    """
+        Computes a contraction path in the format of np.einsum_path for 
+        operands with more subscripts than np.einsum_path supports. Each 
+        step contracts the pair of operands with the smallest intermediate 
+        result.
+    """
+    subscripts = [set(sub) for sub in subscripts]
+    if len(subscripts) == 1:
+        return [(0,)]
+    occurrences = {}
+    for sub in subscripts:
+        for i in sub:
+            occurrences[i] = occurrences.get(i, 0) + 1
+    output = set(output)
+    path = []
+    while len(subscripts) > 1:
+        best = None
+        for j in range(len(subscripts)):
+            for i in range(j):
+                union = subscripts[i] | subscripts[j]
+                result = set(k for k in union if k in output or occurrences[k] > 
+                             (k in subscripts[i]) + (k in subscripts[j]))
+                size = 1
+                for k in result:
+                    size *= sizes[k]
+                if best is None or size < best[0]:
+                    best = (size, i, j, union, result)
+        size, i, j, union, result = best
+        for k in union - result:
+            del occurrences[k]
+        for k in result:
+            occurrences[k] += 1 - (k in subscripts[i]) - (k in subscripts[j])
+        subscripts.pop(j)
+        subscripts.pop(i)
+        subscripts.append(result)
+        path.append((i, j))
+    return path
+
+def _renumber_subscripts(args):
+    """
+        Renumbers the subscripts of a single contraction step in sublist 
+        format to the range supported by np.einsum.
+    """
+    ids = {}
+    res = list(args)
+    for pos in range(1, len(res), 2):
+        res[pos] = [ids.setdefault(i, len(ids)) for i in res[pos]]
+    res[-1] = [ids.setdefault(i, len(ids)) for i in res[-1]]
+    if len(ids) > MAX_EINSUM_VARIABLES:
+        raise ValueError("The product requires an intermediate factor over " \
+                         "more than {} variables.".format(MAX_EINSUM_VARIABLES))
+    return res
+
+def _sample_getter(variableValues):
+    """
+        Returns a function that extracts the instantiations of the given
+        variables from a sample dictionary as a tuple.
+    """
+    names = list(variableValues)
+    if len(names) == 1:
+        return lambda s: (s[names[0]],)
+    if not names:
+        return lambda s: ()
+    return operator.itemgetter(*names)
+
+def _encode_states(states, variableValues):
+    """
+        Converts a list of tuples containing the instantiations of the given
+        variables into an integer coded np.array. The conversion is done per
+        variable with a lookup of the values' indices.
+    """
+    names = list(variableValues)
+    res = np.zeros((len(states), len(names)), dtype=np.intp)
+    if not states or not names:
+        return res
+    for i, v in enumerate(names):
+        # Look up the original values instead of building a single array of 
+        # all states, which would coerce mixed value types to strings
+        lookup = {value: idx for idx, value in enumerate(variableValues[v])}
+        try:
+            res[:, i] = [lookup[state[i]] for state in states]
+        except KeyError as e:
+            raise ValueError("The sampled value {} is not one of the possible " \
+                             "values ({}) for variable {}."
+                             .format(e.args[0], list(variableValues[v]), v))
+    return res
+
 class Factor(object):
     """
         Class representing a factor in an inference network.
@@ -39,6 +243,11 @@ class Factor(object):
         self.variableOrder = []
         # Use a dictionary for the values (as tuple) with the variables as keys.
         self.values = {}
+        #Natural logarithm of a constant factor that the potentials are scaled
+        #with, i.e. the represented values are exp(logScale) * potentials.
+        #This allows to keep the potentials in a numerically safe range, see
+        #rescale.
+        self.logScale = 0.0
         
 
     
@@ -85,6 +294,11 @@ class Factor(object):
                 Factor
                 The sum of this (utility) factor and the other factor.
         """
+        if self.logScale != other.logScale:
+            # Sums require both summands to use the same scale
+            logScale = max(self.logScale, other.logScale)
+            return self._with_log_scale(logScale) + other._with_log_scale(logScale)
+
         # Shortcuts for trivial factors
         if len(self.variableOrder) == 0:
             res = other.copy()
@@ -96,43 +310,8 @@ class Factor(object):
             res.potentials = res.potentials + other.potentials
             return res
         
-        res = Factor()
-        res.variableOrder = list(self.variableOrder)
-        res.values = dict(self.values)
-        extra_vars = set(other.variableOrder) - set(self.variableOrder)
-        #Setup res factor based on self, extended by the missing variables from other
-        if extra_vars:
-            #Create new dimensions for each missing variable
-            slice_ = [slice(None)] * len(self.variableOrder)
-            slice_.extend([np.newaxis] * len(extra_vars))
-            res.potentials = self.potentials[slice_]
-            
-            res.variableOrder.extend(extra_vars)
-            
-            for var in extra_vars:
-                res.values[var] = tuple(other.values[var])
-                
-        else:
-            #This view is ok, since we will overwrite res.potentials below 
-            #when we compute the actual multiplication!
-            res.potentials = self.potentials[:]
-            
-        #modify other
-        f2 = other.copy()
-        extra_vars = set(res.variableOrder) - set(f2.variableOrder)
-        if extra_vars:
-            slice_ = [slice(None)] * len(f2.variableOrder)
-            slice_.extend([np.newaxis] * len(extra_vars))
-            f2.potentials = f2.potentials[slice_]
-            f2.variableOrder.extend(extra_vars)
-            
-        #Rearrange f2 potentials so that dimensions align to the order in res
-        swaparray = [f2.variableOrder.index(var) for var in res.variableOrder]
-        f2.potentials = np.transpose(f2.potentials, swaparray)
-        
-        # Pointwise addition
-        res.potentials = res.potentials + f2.potentials
-        
+        res = self._combine(other, np.add)
+        res.logScale = self.logScale
         return res
     
     def __truediv__(self, other):
@@ -156,7 +335,11 @@ class Factor(object):
             raise ValueError("The divisor's variable are not a subset of the " \
                              "divident's variables: Divisor: {}, Dividend: {}"
                             .format(other.variableOrder, self.variableOrder))
-        return self.__mul__(other.invert(),useOther=False)        
+        if len(other.variableOrder) == 0:
+            return self.__mul__(other.invert(),useOther=False)
+        res = self._combine(other, _safe_divide)
+        res.logScale = self.logScale - other.logScale
+        return res
     
     def __mul__(self, other, useOther=False):
         """
@@ -184,57 +367,151 @@ class Factor(object):
         """
         
         # Shortcuts for trivial factors
+        logScale = self.logScale + other.logScale
         if len(self.variableOrder) == 0:
             res = other if useOther else other.copy()
             res.potentials = self.potentials * res.potentials
+            res.logScale = logScale
             return res
             
         if len(other.variableOrder) == 0:
             res = self.copy()
             res.potentials = res.potentials * other.potentials
+            res.logScale = logScale
             return res
         
-        res = Factor()
-        res.variableOrder = list(self.variableOrder)
-        res.values = dict(self.values)
-        extra_vars = set(other.variableOrder) - set(self.variableOrder)
-        #Setup res factor based on self, extended by the missing variables from other
-        if extra_vars:
-            #Create new dimensions for each missing variable
-            slice_ = [slice(None)] * len(self.variableOrder)
-            slice_.extend([np.newaxis] * len(extra_vars))
-            res.potentials = self.potentials[slice_]
-            
-            res.variableOrder.extend(extra_vars)
-            
-            for var in extra_vars:
-                res.values[var] = tuple(other.values[var])
-                
-        else:
-            #This view is ok, since we will overwrite res.potentials below 
-            #when we compute the actual multiplication!
-            res.potentials = self.potentials[:]
-            
-        #modify other
-        f2 = other if useOther else other.copy()
-        extra_vars = set(res.variableOrder) - set(f2.variableOrder)
-        if extra_vars:
-            slice_ = [slice(None)] * len(f2.variableOrder)
-            slice_.extend([np.newaxis] * len(extra_vars))
-            f2.potentials = f2.potentials[slice_]
-            f2.variableOrder.extend(extra_vars)
-            
-        #Rearrange f2 potentials so that dimensions align to the order in res
-        swaparray = [f2.variableOrder.index(var) for var in res.variableOrder]
-        f2.potentials = np.transpose(f2.potentials, swaparray)
-        
         # Pointwise multiplication which results in a factor where all instantiations
         # are compatible to the instantiations of res and factor2
         # See Definition 6.3 in "Modeling and Reasoning with Bayesian Networks" - Adnan Darwiche Chapter 6    
-        res.potentials = res.potentials * f2.potentials
-        
+        res = self._combine(other, np.multiply)
+        res.logScale = logScale
         return res
     
+    def _combine(self, other, operation):
+        """
+            Helper function that applies the given pointwise operation to the
+            potentials of this and the other factor after aligning their
+            dimensions according to the cached broadcast plan for the two 
+            variable orders. Neither factor is modified.
+            
+            Parameters
+            ----------
+            other : Factor
+                The second operand of the operation.
+            operation : callable
+                Binary function on two broadcastable np.arrays, e.g. np.multiply.
+                
+            Returns
+            -------
+                Factor
+                A new factor over the variables of this factor, extended by the
+                additional variables of the other factor.
+        """
+        plan = _get_broadcast_plan(self.variableOrder, other.variableOrder)
+        res = Factor()
+        res.variableOrder = list(plan.variableOrder)
+        res.values = dict(self.values)
+        for var in plan.extraVariables:
+            res.values[var] = tuple(other.values[var])
+        
+        lhs = self.potentials
+        if plan.lhsPadding:
+            lhs = np.reshape(lhs, np.shape(lhs) + plan.lhsPadding)
+        rhs = other.potentials
+        if plan.rhsPadding:
+            rhs = np.reshape(rhs, np.shape(rhs) + plan.rhsPadding)
+        if plan.rhsAxes is not None:
+            rhs = np.transpose(rhs, plan.rhsAxes)
+        res.potentials = operation(lhs, rhs)
+        return res
+
+    def __imul__(self, other):
+        """
+            In-place multiplication of this factor with the other factor.
+            If the other factor's variables are a subset of this factor's
+            variables, the potentials of this factor are overwritten without
+            allocating a new table. Otherwise the regular (allocating)
+            multiplication is used, as the result requires additional
+            dimensions.
+
+            Paramter
+            -------
+            other : Factor
+                The factor that is multiplied to this factor
+
+            Returns
+            -------
+                Factor
+                This factor if the product could be computed in place,
+                otherwise a new factor.
+        """
+        if len(other.variableOrder) == 0:
+            if self._supports_inplace(other.potentials):
+                self.potentials *= other.potentials
+                self.logScale += other.logScale
+                return self
+            return self * other
+
+        rhs = self._aligned_subset(other)
+        if rhs is None or not self._supports_inplace(rhs):
+            return self * other
+        np.multiply(self.potentials, rhs, out=self.potentials)
+        self.logScale += other.logScale
+        return self
+
+    def __itruediv__(self, other):
+        """
+            In-place division of this factor by the other factor (forcing
+            x/0=0 as with invert). The divisor's variables must be a
+            subset of the dividend's variables.
+
+            Parameter
+            --------
+            other : Factor
+                The factor that this factor is divided with.
+
+            Returns
+            -------
+                Factor
+                This factor if the quotient could be computed in place,
+                otherwise a new factor.
+        """
+        rhs = self._aligned_subset(other) if len(other.variableOrder) > 0 \
+                else None
+        if rhs is None or not self._supports_inplace(rhs):
+            return self / other
+        np.divide(self.potentials, rhs, out=self.potentials, where=(rhs != 0))
+        np.copyto(self.potentials, 0, where=(rhs == 0))
+        self.logScale -= other.logScale
+        return self
+
+    def _aligned_subset(self, other):
+        """
+            Helper function returning a view on the other factor's potentials
+            which broadcasts onto the potentials of this factor, or None if
+            the other factor contains variables that are not part of this
+            factor.
+        """
+        plan = _get_broadcast_plan(self.variableOrder, other.variableOrder)
+        if plan.extraVariables:
+            return None
+        rhs = other.potentials
+        if plan.rhsPadding:
+            rhs = np.reshape(rhs, np.shape(rhs) + plan.rhsPadding)
+        if plan.rhsAxes is not None:
+            rhs = np.transpose(rhs, plan.rhsAxes)
+        return rhs
+
+    def _supports_inplace(self, operand):
+        """
+            Helper function to check whether the potentials of this factor can
+            be overwritten with the result of a pointwise operation with the
+            given operand without changing their dtype.
+        """
+        return isinstance(self.potentials, np.ndarray) \
+                and self.potentials.flags.writeable \
+                and np.result_type(self.potentials, operand) == self.potentials.dtype
+
     def copy(self):
         """
             Creates a (deep) copy of this factor.
@@ -252,6 +529,17 @@ class Factor(object):
         #modification of these lists impossible.
         res.values = dict(self.values)
         res.variableOrder = list(self.variableOrder)
+        res.logScale = self.logScale
+        return res
+
+    def _with_log_scale(self, logScale):
+        """
+            Helper function returning a copy of this factor representing the
+            same values, but using the given scale.
+        """
+        res = self.copy()
+        res.potentials = res.potentials * np.exp(self.logScale - logScale)
+        res.logScale = logScale
         return res
 
     def invert(self):
@@ -277,10 +565,11 @@ class Factor(object):
             with np.errstate(divide='ignore', invalid="ignore"):
                 res.potentials = 1.0 / res.potentials
                 res.potentials[res.potentials==np.inf] = 0
+        res.logScale = -self.logScale
         return res
 
     @classmethod
-    def from_samples(cls, samples, variableValues):
+    def from_samples(cls, samples, variableValues, chunkSize=10000):
         """
             Creates a sample over the given variables and
             computes their potentials from the given samples. The resulting
@@ -290,13 +579,20 @@ class Factor(object):
 
             Parameters
             ----------
-            samples : [dict,]
-                List of states where each state is represented with a dictionary
-                containing the variables as keys and their instantiation as value.
+            samples : [dict,] or np.array
+                Either an iterable (e.g. a list or a generator) of states
+                where each state is represented with a dictionary containing 
+                the variables as keys and their instantiation as value, or an
+                integer coded (samples x variables) np.array as described in
+                count_samples.
 
             variableValues: dict
                 A dictionary containing the variables as keys and their value
                 lists as values over which this factor is defined.
+                
+            chunkSize: int, optional
+                The number of dictionary samples that are encoded together
+                (default 10000).
 
             Returns
             -------
@@ -304,22 +600,135 @@ class Factor(object):
                 A factor representing the joint probability of the given
                 variables according to the given samples.
         """
-
+        counts = cls.count_samples(samples, variableValues, chunkSize=chunkSize)
+        return cls.from_counts(counts, variableValues)
+        
+    @classmethod
+    def from_counts(cls, counts, variableValues):
+        """
+            Creates a factor representing the joint probability of the given
+            variables from the (accumulated) sample counts created by 
+            count_samples.
+            
+            Parameters
+            ----------
+            counts : np.array
+                The number of samples for each joint instantiation, with one
+                axis per variable in the order of variableValues.
+            
+            variableValues: dict
+                A dictionary containing the variables as keys and their value
+                lists as values over which this factor is defined.
+                
+            Returns
+            -------
+                Factor
+                A factor over the given variables containing the relative
+                frequencies of the counts.
+        """
         res = cls()
-        shape = []
-        for i, v in enumerate(variableValues):
+        for v in variableValues:
             res.variableOrder.append(v)
-#            res.variables[v] = i
             res.values[v] = tuple(variableValues[v])
-            shape.append(len(variableValues[v]))
-        res.potentials = np.zeros(shape)
-        for s in samples:
-            idx = []
-            for v in res.variableOrder:
-                idx.append(res.values[v].index(s[v]))
-            res.potentials[tuple(idx)] += 1
-        res.potentials /= np.sum(res.potentials)
+        res.potentials = np.array(counts, dtype=float)
+        res.normalize()
         return res
+        
+    @staticmethod
+    def encode_samples(samples, variableValues):
+        """
+            Converts the given samples into an integer coded np.array, 
+            containing the index of each variable's instantiation within its
+            value list. The conversion is done per variable for all samples
+            at once.
+            
+            Parameters
+            ----------
+            samples : [dict,]
+                List of states where each state is represented with a dictionary
+                containing the variables as keys and their instantiation as value.
+                
+            variableValues: dict
+                A dictionary containing the variables as keys and their value
+                lists as values.
+                
+            Returns
+            -------
+                np.array
+                A (samples x variables) integer array with the variables in
+                the order of variableValues.
+        """
+        getter = _sample_getter(variableValues)
+        return _encode_states([getter(s) for s in samples], variableValues)
+        
+    @staticmethod
+    def count_samples(samples, variableValues, counts=None, chunkSize=10000):
+        """
+            Counts how often each joint instantiation of the given variables
+            occurs within the given samples. The counts are computed with a
+            single np.bincount over the flat indices of the samples. If 
+            counts from earlier calls are given, the new samples are added 
+            to them, which allows to accumulate counts from a stream of 
+            samples online.
+            
+            Parameters
+            ----------
+            samples : [dict,] or np.array
+                Either an iterable (e.g. a list or a generator) of states
+                where each state is represented with a dictionary containing 
+                the variables as keys and their instantiation as value, or an
+                integer coded (samples x variables) np.array, containing the
+                index of each variable's instantiation within its value list
+                with the columns in the order of variableValues. Iterables are
+                consumed and encoded in chunks of chunkSize samples, so the
+                same dictionary may be reused for each yielded sample.
+                
+            variableValues: dict
+                A dictionary containing the variables as keys and their value
+                lists as values.
+                
+            counts : np.array, optional
+                Counts of previous samples which are updated in place.
+                
+            chunkSize: int, optional
+                The number of dictionary samples that are encoded together
+                (default 10000).
+                
+            Returns
+            -------
+                np.array
+                The counts with one axis per variable in the order of 
+                variableValues.
+        """
+        shape = tuple(len(variableValues[v]) for v in variableValues)
+        if counts is None:
+            counts = np.zeros(shape)
+        elif np.shape(counts) != shape:
+            raise ValueError("The shape of the counts {} does not match the " \
+                             "variables' values {}.".format(np.shape(counts), shape))
+        if isinstance(samples, np.ndarray):
+            chunks = [samples]
+        else:
+            samples = iter(samples)
+            getter = _sample_getter(variableValues)
+            def encoded_chunks():
+                while True:
+                    # Only the values are kept as the samples may be reused
+                    states = [getter(s) for s in itertools.islice(samples, chunkSize)]
+                    if not states:
+                        return
+                    yield _encode_states(states, variableValues)
+            chunks = encoded_chunks()
+        for codes in chunks:
+            codes = np.asarray(codes, dtype=np.intp).reshape(-1, len(shape))
+            if not len(codes):
+                continue
+            if not shape:
+                counts += len(codes)
+                continue
+            flatIndices = np.ravel_multi_index(tuple(codes.T), shape)
+            counts += np.bincount(flatIndices, minlength=counts.size).reshape(shape)
+        return counts
 
 
     @classmethod
@@ -529,17 +938,165 @@ class Factor(object):
                 A new factor where the given variables has been summed out.
         """
         
-        if not isinstance(variables, (list,set)):
-            variables = [variables]
+        axes, remaining = self._marginalization_axes(variables)
+        res = Factor()
+        res.variableOrder = remaining
+        res.values = {v: self.values[v] for v in remaining}
+        res.potentials = np.sum(self.potentials, axis=axes)
+        res.logScale = self.logScale
+        return res
+
+    def marginalize_into(self, variables, out):
+        """
+            Sums the given variables out of this factor and writes the result
+            into the potentials of the given factor, without allocating a new
+            factor. The out-factor needs to be defined over exactly the
+            remaining variables, but may use a different variable order.
             
-        res = self.copy()
-        for v in variables:
-            res.potentials = np.sum(res.potentials, axis=res.variableOrder.index(v))
-            del res.values[v]
-            res.variableOrder.remove(v)
+            Parameter
+            ---------
+            variables: String, RandomNode, [String,], [RandomNode,], set(String,) or set(RandomNode)
+                Either a single variable or a list of variables that are to
+                be removed.
+            out: Factor
+                Factor over the remaining variables whose potentials are
+                overwritten with the result.
+                
+            Returns
+            ------
+                Factor
+                The given out-factor.
+        """
+        axes, remaining = self._marginalization_axes(variables)
+        if out.variableOrder == remaining:
+            np.sum(self.potentials, axis=axes, out=out.potentials)
+        else:
+            plan = _get_broadcast_plan(out.variableOrder, remaining)
+            if plan.extraVariables or len(remaining) != len(out.variableOrder):
+                raise ValueError("The out factor's variables {} do not match " \
+                                 "the remaining variables {}."
+                                 .format(out.variableOrder, remaining))
+            np.copyto(out.potentials, 
+                      np.transpose(np.sum(self.potentials, axis=axes), plan.rhsAxes))
+        out.logScale = self.logScale
+        return out
+        
+    @classmethod
+    def product_marginalize(cls, factors, keep, out=None):
+        """
+            Computes the product of the given factors and sums out all 
+            variables that are not kept, without building the table of the 
+            full product. The computation is performed by np.einsum along an
+            optimized contraction path, which is cached for each combination
+            of variable orders and kept variables.
+            None of the given factors is modified.
             
+            Parameter
+            ---------
+            factors: [Factor,]
+                The factors to be multiplied.
+            keep: [String,]
+                The variables that should remain in the result, in the order
+                that the result should use.
+            out: Factor, optional
+                Factor over exactly the kept variables whose potentials are 
+                overwritten with the result. Its variable order is used
+                instead of the order of keep. If the potentials cannot hold
+                the result's dtype, they are replaced by the result.
+                
+            Returns
+            ------
+                Factor
+                A new factor (or the out-factor) over the kept variables.
+        """
+        if out is not None:
+            if set(out.variableOrder) != set(keep) or len(out.variableOrder) != len(keep):
+                raise ValueError("The out factor's variables {} do not match " \
+                                 "the kept variables {}."
+                                 .format(out.variableOrder, list(keep)))
+            keep = out.variableOrder
+        values = {}
+        for f in factors:
+            values.update(f.values)
+        for v in keep:
+            if v not in values:
+                raise ValueError("The kept variable {} is not contained in any " \
+                                 "of the factors.".format(v))
+        logScale = sum(f.logScale for f in factors)
+        
+        if not factors:
+            potentials = np.ones(())
+        else:
+            # np.einsum only supports a limited number of subscripts, which 
+            # are therefore renumbered for each step of wider products
+            wide = len(values) > MAX_EINSUM_VARIABLES
+            ids = {v: i for i, v in enumerate(values)}
+            operands = []
+            for f in factors:
+                operands.append(np.asarray(f.potentials))
+                operands.append([ids[v] for v in f.variableOrder])
+            operands.append([ids[v] for v in keep])
+            key = (tuple(tuple(f.variableOrder) for f in factors),
+                   tuple(np.shape(f.potentials) for f in factors),
+                   tuple(keep))
+            plan = _get_einsum_plan(operands, key)
+            arrays = operands[0:-1:2]
+            subscripts = operands[1:-1:2]
+            for positions, result in plan[:-1]:
+                args = []
+                for p in positions:
+                    args.append(arrays.pop(p))
+                    args.append(subscripts.pop(p))
+                args.append(result)
+                if wide:
+                    args = _renumber_subscripts(args)
+                arrays.append(np.einsum(*args, optimize=False))
+                subscripts.append(result)
+            args = []
+            for p in plan[-1][0]:
+                args.append(arrays.pop(p))
+                args.append(subscripts.pop(p))
+            args.append(plan[-1][1])
+            if wide:
+                args = _renumber_subscripts(args)
+            if out is not None and np.can_cast(np.result_type(*args[0:-1:2]), 
+                                               out.potentials.dtype):
+                np.einsum(*args, optimize=False, out=out.potentials)
+                out.logScale = logScale
+                return out
+            potentials = np.einsum(*args, optimize=False)
+            if len(plan) == 1 and len(plan[0][0]) == 1 and \
+                    np.may_share_memory(potentials, args[0]):
+                # Einsum returns a view when it only permutes a single factor
+                potentials = potentials.copy()
+        
+        if out is not None:
+            if np.can_cast(potentials.dtype, out.potentials.dtype):
+                np.copyto(out.potentials, potentials)
+            else:
+                # Keep the precision of e.g. float128 potentials
+                out.potentials = potentials
+            out.logScale = logScale
+            return out
+        res = cls()
+        res.variableOrder = list(keep)
+        res.values = {v: values[v] for v in keep}
+        res.potentials = potentials
+        res.logScale = logScale
         return res
         
+    def _marginalization_axes(self, variables):
+        """
+            Helper function to determine the axes that need to be summed over
+            when the given variables are marginalized, together with the
+            variable order of the result.
+        """
+        if not isinstance(variables, (list,set,tuple,frozenset)):
+            variables = [variables]
+        axes = tuple(sorted(set(self.variableOrder.index(v) for v in variables)))
+        remaining = [v for i, v in enumerate(self.variableOrder) if i not in axes]
+        return axes, remaining
+        
     def get_potential(self, variables=None):
         """
             Function that allows to query for specifiy potentials within this 
@@ -589,6 +1146,44 @@ class Factor(object):
         potentialSum = np.sum(self.potentials)
         if potentialSum > 0:
             self.potentials /= potentialSum
+            self.logScale = 0.0
+
+    def rescale(self):
+        """
+            Rescales the potentials so that they add up to 1, while keeping
+            the represented values unchanged by accumulating the removed
+            normalization constant in logScale. Repeatedly rescaling the
+            intermediate results of long products prevents the potentials
+            from underflowing to zero. 
+            
+            Returns
+            -------
+                Factor
+                This factor.
+        """
+        potentialSum = np.sum(self.potentials)
+        if potentialSum > 0:
+            self.potentials /= potentialSum
+            self.logScale += np.log(potentialSum)
+        return self
+
+    def get_log_sum(self):
+        """
+            Returns the natural logarithm of the sum over all represented 
+            values of this factor, taking its logScale into account. 
+            For the product of all CPDs and evidence of a network, this is the
+            log probability of the evidence.
+            
+            Returns
+            -------
+                float
+                The log of the sum over all values, or -inf if all potentials
+                are zero.
+        """
+        potentialSum = np.sum(self.potentials)
+        if potentialSum <= 0:
+            return -np.inf
+        return self.logScale + np.log(potentialSum)
             
             
     @classmethod
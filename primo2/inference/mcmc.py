@@ -19,13 +19,521 @@
 # License along with this program.  If not, see
 # <http://www.gnu.org/licenses/>.
 
+from collections import OrderedDict
+import copy
+import itertools
+import multiprocessing
 import random
 
+import networkx as nx
+import numpy as np
+
 from .factor import Factor
 
+
+def _sample_index(weights, rng):
+    """
+        Performs roulette-wheel-sampling on the given (unnormalized) weights
+        and returns the index of the chosen entry. The weights of a single
+        variable are few, so a plain loop is faster than numpy here.
+    """
+    weights = weights.tolist()
+    rndVal = rng.random() * sum(weights)
+    s = 0
+    for i, w in enumerate(weights):
+        s += w
+        if s >= rndVal:
+            return i
+    return len(weights) - 1
+
+
+def _sample_indices(weights, randomState):
+    """
+        Performs roulette-wheel-sampling for each row of the given 
+        (unnormalized) weights at once and returns the chosen indices.
+    """
+    cumulative = np.cumsum(weights, axis=1)
+    rndVals = randomState.random_sample(len(weights)) * cumulative[:, -1]
+    indices = np.sum(cumulative < rndVals[:, np.newaxis], axis=1)
+    return np.minimum(indices, weights.shape[1] - 1)
+
+# Compiled network of the current process' chains. Worker processes receive
+# it once when they are started, instead of once per chain.
+_chainNetwork = None
+
+def _init_chain_worker(network):
+    """
+        Initializer of the worker processes running compiled chains.
+    """
+    global _chainNetwork
+    _chainNetwork = network
+    
+def _compiled_chain_batches(sampler, seed, network, numSamples, evidence, 
+                            queryIndices, variableValues, batchSize):
+    """
+        Generator running a single compiled markov chain with its own random
+        number generator, which yields the counts of the joint instantiations
+        of the query variables for each batch of batchSize samples (the last
+        batch may be smaller). This way, memory does not grow with the 
+        length of the chain.
+    """
+    sampler = copy.deepcopy(sampler)
+    sampler.transitionModel.rng = random.Random(seed)
+    initialState = network.sample_forward(evidence, sampler.transitionModel.rng)
+    chunk = np.zeros((min(numSamples, batchSize), len(queryIndices)), dtype=np.intp)
+    filled = 0
+    for state in sampler.generate_compiled_chain(network, numSamples, initialState, evidence):
+        chunk[filled] = state[queryIndices]
+        filled += 1
+        if filled == len(chunk):
+            yield Factor.count_samples(chunk, variableValues)
+            filled = 0
+    if filled:
+        yield Factor.count_samples(chunk[:filled], variableValues)
+    
+def _run_compiled_chain(args):
+    """
+        Runs a single compiled markov chain within a worker process.
+        
+        Parameters
+        ----------
+        args : tuple
+            The arguments of _compiled_chain_batches except for the network.
+            
+        Returns
+        -------
+            np.array
+            The (batches x query instantiations) counts of the chain.
+    """
+    sampler, seed, numSamples, evidence, queryIndices, variableValues, batchSize = args
+    return np.array(list(_compiled_chain_batches(sampler, seed, _chainNetwork, 
+                            numSamples, evidence, queryIndices, variableValues, batchSize)))
+    
+
+class ChainDiagnostics(object):
+    """
+        Convergence diagnostics of markov chains, computed from the number 
+        of times each joint instantiation of the query variables was sampled
+        within consecutive batches of each chain. The diagnostics consider 
+        the indicator of each instantiation and report the worst value over
+        all instantiations:
+        
+        - The split Gelman-Rubin statistic R-hat, for which each chain is
+          split into two halves ("Bayesian Data Analysis" - Gelman et al.
+          Chapter 11.4). Values close to 1 indicate that all (half) chains 
+          have converged to the same distribution.
+        - The effective sample size, using the variance of the batch means 
+          as estimate of the asymptotic variance of the chains.
+        - The variance of the pooled marginals, i.e. the squared standard 
+          error of the estimate, from the same batch means.
+    """
+    
+    def __init__(self, batchCounts, batchSize, burnIn=0):
+        """
+            Parameters
+            ----------
+            batchCounts : np.array
+                The (chains x batches x query instantiations) counts of 
+                full batches, i.e. additional axes for each query variable
+                instead of a single axis for all instantiations are allowed.
+            batchSize : int
+                The number of samples of each batch.
+            burnIn : int, optional
+                The number of samples of each chain that were discarded 
+                before the batches.
+                
+            The attribute converged is None, unless the diagnostics were 
+            created by MCMC.adaptive_marginals, which sets it to whether 
+            the target precision was reached before maxSamples.
+        """
+        batchCounts = np.asarray(batchCounts, dtype=float)
+        self.shape = batchCounts.shape[2:]
+        self.numChains, self.numBatches = batchCounts.shape[:2]
+        self.batchSize = batchSize
+        self.burnIn = burnIn
+        #Number of samples per chain
+        self.numSamples = self.numBatches * batchSize
+        #Set by MCMC.adaptive_marginals
+        self.converged = None
+        self._batchMeans = batchCounts.reshape(self.numChains, self.numBatches, 
+                                               int(np.prod(self.shape))) / batchSize
+        
+    def rhat(self):
+        """
+            Returns the split R-hat statistic, or infinity if there are
+            less than two batches per chain.
+        """
+        half = self.numBatches // 2
+        if half < 1:
+            return np.inf
+        # Drop the first batch if the number of batches is odd
+        halves = np.concatenate([self._batchMeans[:, -2*half:-half], 
+                                 self._batchMeans[:, -half:]])
+        n = half * self.batchSize
+        chainMeans = np.mean(halves, axis=1)
+        within = np.mean(chainMeans * (1 - chainMeans), axis=0) * n / max(n - 1, 1)
+        between = n * np.var(chainMeans, axis=0, ddof=1)
+        varPlus = (n - 1) / n * within + between / n
+        res = np.ones(len(within))
+        positive = within > 0
+        res[positive] = np.sqrt(varPlus[positive] / within[positive])
+        res[~positive & (between > 0)] = np.inf
+        return float(np.max(res)) if len(res) else 1.0
+        
+    def _asymptotic_variance(self):
+        """
+            Helper function estimating the asymptotic variance of each 
+            indicator from the variance of the batch means within each chain.
+        """
+        if self.numBatches < 2:
+            pooled = np.mean(self._batchMeans, axis=(0, 1))
+            return pooled * (1 - pooled)
+        return self.batchSize * np.mean(np.var(self._batchMeans, axis=1, ddof=1), axis=0)
+        
+    def effective_sample_size(self):
+        """
+            Returns the effective sample size of all chains together, which
+            is at most the total number of samples.
+        """
+        total = self.numChains * self.numSamples
+        pooled = np.mean(self._batchMeans, axis=(0, 1))
+        variance = pooled * (1 - pooled)
+        asymptotic = self._asymptotic_variance()
+        relevant = variance > 0
+        if not np.any(relevant):
+            return float(total)
+        ess = np.full(len(variance), float(total))
+        dependent = relevant & (asymptotic > 0)
+        ess[dependent] = total * variance[dependent] / asymptotic[dependent]
+        return float(min(np.min(ess[relevant]), total))
+        
+    def marginal_variance(self):
+        """
+            Returns the variance of the pooled estimate of each joint 
+            instantiation's probability, in the shape of the query.
+        """
+        total = max(self.numChains * self.numSamples, 1)
+        return (self._asymptotic_variance() / total).reshape(self.shape)
+        
+    def standard_error(self):
+        """
+            Returns the largest standard error of the pooled estimates.
+        """
+        variance = self.marginal_variance()
+        return float(np.sqrt(np.max(variance))) if variance.size else 0.0
+        
+
+class CompiledNetwork(object):
+    """
+        Representation of a BayesianNetwork for fast sampling. The state of
+        the network is an integer np.array containing the index of each
+        variable's value, all CPDs are flattened into one array and each 
+        variable knows the strides of its own CPD and the CPDs of its 
+        children. This allows computing the distribution of a variable given
+        its Markov blanket with a handful of vectorized operations, without
+        any dictionary lookups or copies.
+        The compiled network does not reflect later changes to the network.
+    """
+    
+    def __init__(self, bn):
+        """
+            Parameters
+            ----------
+            bn : BayesianNetwork
+                The network to be compiled.
+        """
+        nodes = list(nx.topological_sort(bn.graph))
+        #Variables are numbered in topological order
+        self.names = [node.name for node in nodes]
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.values = [list(node.values) for node in nodes]
+        self.cardinalities = np.array([len(v) for v in self.values], dtype=np.intp)
+        
+        #Family (variable followed by its parents) of each variable together
+        #with the strides of the family within the flattened CPD
+        self.families = []
+        self.strides = []
+        self.cpdOffsets = np.zeros(len(nodes), dtype=np.intp)
+        cpds = []
+        offset = 0
+        for i, node in enumerate(nodes):
+            family = [i] + [self.index[p] for p in node.parentOrder]
+            shape = self.cardinalities[family]
+            strides = np.ones(len(family), dtype=np.intp)
+            strides[:-1] = np.cumprod(shape[::-1])[::-1][1:]
+            self.families.append(np.array(family, dtype=np.intp))
+            self.strides.append(strides)
+            self.cpdOffsets[i] = offset
+            cpd = np.ravel(np.asarray(node.cpd, dtype=float))
+            cpds.append(cpd)
+            offset += len(cpd)
+        self.cpds = np.concatenate(cpds) if cpds else np.zeros(0)
+        
+        #The Markov blanket distribution of each variable is the product of
+        #its own CPD and its children's CPDs (the terms), each evaluated for
+        #all values of the variable. The offset of each term within the
+        #flattened CPDs is linear in the values of the Markov blanket, given
+        #by a (terms x blanket) stride matrix, while the steps (terms x 
+        #values) move along the values of the variable itself.
+        children = [[] for node in nodes]
+        for i, family in enumerate(self.families):
+            for p in family[1:]:
+                children[p].append(i)
+        self.blanketTerms = []
+        self._blankets = []
+        self._blanketStrides = []
+        self._blanketSteps = []
+        for i in range(len(nodes)):
+            terms = [i] + children[i]
+            self.blanketTerms.append(np.array(terms, dtype=np.intp))
+            blanket = sorted(set(v for t in terms for v in self.families[t]) - set([i]))
+            position = {v: k for k, v in enumerate(blanket)}
+            strides = np.zeros((len(terms), len(blanket)), dtype=np.intp)
+            steps = np.zeros((len(terms), self.cardinalities[i]), dtype=np.intp)
+            for k, t in enumerate(terms):
+                for v, stride in zip(self.families[t], self.strides[t]):
+                    if v == i:
+                        steps[k] = np.arange(self.cardinalities[i]) * stride
+                    else:
+                        strides[k, position[v]] = stride
+                steps[k] += self.cpdOffsets[t]
+            self._blankets.append(np.array(blanket, dtype=np.intp))
+            self._blanketStrides.append(strides)
+            self._blanketSteps.append(steps)
+        self._scalarTerms = None
+            
+    def encode_state(self, state):
+        """
+            Converts a state dictionary into an integer coded state.
+            
+            Parameters
+            ----------
+            state : dict
+                Dictionary containing the names of all variables as keys and
+                their instantiation as values.
+                
+            Returns
+            -------
+                np.array
+                The index of each variable's value, in the order of names.
+        """
+        return np.array([self.values[i].index(state[name]) 
+                            for i, name in enumerate(self.names)], dtype=np.intp)
+        
+    def decode_state(self, state):
+        """
+            Converts an integer coded state into a state dictionary.
+            
+            Parameters
+            ----------
+            state : np.array
+                The index of each variable's value, in the order of names.
+                
+            Returns
+            -------
+                dict
+                Dictionary containing the names of all variables as keys and
+                their instantiation as values.
+        """
+        return {name: self.values[i][state[i]] for i, name in enumerate(self.names)}
+        
+    def encode_evidence(self, evidence):
+        """
+            Converts the given evidence into a dictionary mapping the number
+            of each evidence variable to the index of its observed value.
+        """
+        res = {}
+        for e in evidence:
+            i = self.index[e]
+            if not evidence[e] in self.values[i]:
+                raise ValueError("Evidence {} is not one of the possible values " \
+                                 "({}) for this variable."
+                                 .format(evidence[e], self.values[i]))
+            res[i] = self.values[i].index(evidence[e])
+        return res
+        
+    def sample_forward(self, evidence, rng):
+        """
+            Creates an initial state by sampling each variable given its 
+            parents in topological order, analogous to 
+            BayesianNetwork.get_sample.
+            
+            Parameters
+            ----------
+            evidence : dict
+                Dictionary mapping the number of each evidence variable to
+                the index of its observed value (see encode_evidence).
+            rng : random.Random
+                The random number generator to be used.
+                
+            Returns
+            -------
+                np.array
+                The integer coded state.
+        """
+        state = np.zeros(len(self.names), dtype=np.intp)
+        for i in range(len(self.names)):
+            if i in evidence:
+                state[i] = evidence[i]
+                continue
+            family = self.families[i]
+            strides = self.strides[i]
+            offset = self.cpdOffsets[i] + np.dot(state[family[1:]], strides[1:])
+            state[i] = _sample_index(
+                    self.cpds[offset + np.arange(self.cardinalities[i]) * strides[0]], rng)
+        return state
+        
+    def sample_forward_batch(self, evidence, numStates, randomState):
+        """
+            Creates many initial states at once by sampling each variable 
+            given its parents in topological order, see sample_forward.
+            
+            Parameters
+            ----------
+            evidence : dict
+                Dictionary mapping the number of each evidence variable to
+                the index of its observed value (see encode_evidence).
+            numStates : int
+                The number of states to be created.
+            randomState : np.random.RandomState
+                The random number generator to be used.
+                
+            Returns
+            -------
+                np.array
+                The (states x variables) integer coded states.
+        """
+        states = np.zeros((numStates, len(self.names)), dtype=np.intp)
+        for i in range(len(self.names)):
+            if i in evidence:
+                states[:, i] = evidence[i]
+                continue
+            family = self.families[i]
+            strides = self.strides[i]
+            offsets = self.cpdOffsets[i] + states[:, family[1:]].dot(strides[1:])
+            indices = offsets[:, np.newaxis] + np.arange(self.cardinalities[i]) * strides[0]
+            states[:, i] = _sample_indices(self.cpds[indices], randomState)
+        return states
+        
+    def cpd_terms(self, state):
+        """
+            Returns the CPD entry of each variable for the given state, i.e.
+            the probability of each variable's value given its parents' values.
+            
+            Parameters
+            ----------
+            state : np.array
+                The integer coded state of the network.
+                
+            Returns
+            -------
+                np.array
+                The probabilities in the order of names.
+        """
+        indices = [self.cpdOffsets[i] + self.strides[i].dot(state[self.families[i]])
+                        for i in range(len(self.names))]
+        return self.cpds[np.array(indices, dtype=np.intp)]
+        
+    def blanket_indices(self, state, variable):
+        """
+            Computes the indices of the entries within the flattened CPDs 
+            that make up the Markov blanket distribution of the given variable.
+            
+            Parameters
+            ----------
+            state : np.array
+                The integer coded state of the network.
+            variable : int
+                The number of the variable.
+                
+            Returns
+            -------
+                np.array
+                A (terms x values) array, containing the indices of the CPD
+                entries of the variable itself and of each of its children 
+                (in the order of blanketTerms) for each value of the variable.
+        """
+        # Methods are used directly, as the overhead of the numpy functions' 
+        # dispatching is noticeable for these small arrays
+        offsets = self._blanketStrides[variable].dot(state[self._blankets[variable]])
+        return self._blanketSteps[variable] + offsets[:, np.newaxis]
+        
+    def scalar_terms(self):
+        """
+            Returns the Markov blanket terms of all variables as plain python
+            structures for looking up single CPD entries, which is much 
+            faster than numpy operations on tiny arrays. 
+            
+            Returns
+            -------
+                [[(int, int, int, [(int, int),]),],], [float,]
+                For each variable, one tuple per term containing the number
+                of the term's variable, the offset of its CPD, the stride of
+                the variable within that CPD and the (variable, stride) pairs
+                of the remaining family. The second value is the list of all
+                CPD entries.
+        """
+        if self._scalarTerms is None:
+            terms = []
+            for i in range(len(self.names)):
+                variableTerms = []
+                for t in self.blanketTerms[i]:
+                    family = zip(self.families[t].tolist(), self.strides[t].tolist())
+                    rest = [(v, stride) for v, stride in family if v != i]
+                    stride = self.strides[t][list(self.families[t]).index(i)]
+                    variableTerms.append((int(t), int(self.cpdOffsets[t]), int(stride), rest))
+                terms.append(variableTerms)
+            self._scalarTerms = (terms, self.cpds.tolist())
+        return self._scalarTerms
+        
+    def markov_weights_batch(self, states, variable):
+        """
+            Computes the unnormalized distribution of the given variable 
+            given its Markov blanket for many states at once, see 
+            markov_weights.
+            
+            Parameters
+            ----------
+            states : np.array
+                The (states x variables) integer coded states.
+            variable : int
+                The number of the variable.
+                
+            Returns
+            -------
+                np.array
+                A (states x values) array containing the product of the 
+                variable's CPD and its children's CPDs for each value of the
+                variable in each state.
+        """
+        offsets = states[:, self._blankets[variable]].dot(self._blanketStrides[variable].T)
+        indices = offsets[:, :, np.newaxis] + self._blanketSteps[variable]
+        return np.multiply.reduce(self.cpds[indices], axis=1)
+        
+    def markov_weights(self, state, variable):
+        """
+            Computes the unnormalized distribution of the given variable 
+            given the current instantiation of its Markov blanket.
+            
+            Parameters
+            ----------
+            state : np.array
+                The integer coded state of the network.
+            variable : int
+                The number of the variable.
+                
+            Returns
+            -------
+                np.array
+                The product of the variable's CPD and its children's CPDs for
+                each value of the variable.
+        """
+        return np.multiply.reduce(self.cpds[self.blanket_indices(state, variable)], axis=0)
+
 class MCMC(object):
     
-    def __init__(self, bn, transitionModel=None, numSamples=1000, burnIn=1000, fullChange=False):
+    def __init__(self, bn, transitionModel=None, numSamples=1000, burnIn=1000, fullChange=False,
+                 numChains=1, workers=1, lockstep=False):
         """
             Creates a markov cain monte carlo instance which is used to 
             approximate marginals on a given BayesianNetwork.
@@ -48,10 +556,37 @@ class MCMC(object):
             fullChange : bool, optional
                 If true, a step in the sampler is considered after resampling all variables, 
                 instead of only a single one (Default: False)
+                
+            numChains : int, optional
+                Number of independent chains, each of which draws numSamples
+                samples after its own burnIn. The counts of all chains are 
+                pooled. (Default: 1)
+                
+            workers : int, optional
+                Number of processes used to run the chains of transition 
+                models that support compiled networks. If 1, all chains are 
+                run in this process. (Default: 1)
+                
+            lockstep : bool, optional
+                If true, all chains are advanced together in one process, 
+                with the states of all chains stored in a single matrix, so 
+                that each step is a few vectorized operations over all chains.
+                This is efficient for large numbers of chains and requires a
+                transition model supporting it (e.g. GibbsTransition). 
+                workers is ignored in this case. (Default: False)
         """
         self.bn = bn
         self.numSamples = numSamples
+        self.numChains = numChains
+        self.workers = workers
+        self.lockstep = lockstep
         self.sampler = MarkovChainSampler(transitionModel, burnIn, fullChange)
+        if lockstep and not self.sampler.transitionModel.lockstep:
+            raise ValueError("The transition model does not support lockstep chains.")
+        #Statistics of each chain and convergence diagnostics of the last
+        #call to marginals
+        self.chainStatistics = []
+        self.diagnostics = None
     
     def marginals(self, variables, evidence=None):
         """
@@ -71,19 +606,226 @@ class MCMC(object):
             -------
                 Factor
                 A factor over the given variables representing their joint probability 
-                given the evidence.
+                given the evidence, pooled over all chains. The statistics of
+                each chain (its seed, number of samples, counts and marginals)
+                are stored as dictionaries in chainStatistics and the 
+                convergence diagnostics of all chains as ChainDiagnostics in
+                diagnostics.
         """
         if not evidence:
             evidence = {}
-        initialState = self.bn.get_sample(evidence)
-        sampleChain = self.sampler.generate_markov_chain(self.bn, self.numSamples, initialState, evidence)
-        # Compute probability for variables given the samples
-        variableValues = {v: self.bn.get_node(v).values for v in variables}
-        res = Factor.from_samples(sampleChain, variableValues)
+        variableValues = OrderedDict((v, self.bn.get_node(v).values) for v in variables)
+        # Roughly 20 batches per chain suffice for the diagnostics
+        batchSize = max(1, -(-self.numSamples // 20))
+        seeds = self._chain_seeds()
+        if self.numSamples <= 0:
+            # No batches at all, but the counts keep their usual shape
+            shape = tuple(len(variableValues[v]) for v in variableValues)
+            batchCounts = np.zeros((self.numChains, 0) + shape)
+        elif self.sampler.transitionModel.compiled and not self.lockstep \
+                and self.workers > 1 and self.numChains > 1:
+            batchCounts = self._pooled_batches(self.sampler, seeds, variables, 
+                                               evidence, variableValues, batchSize)
+        else:
+            batches = self._chain_batches(self.sampler, seeds, self.numSamples, 
+                                          variables, evidence, variableValues, batchSize)
+            batchCounts = np.stack(list(batches), axis=1)
+        return self._summarize(batchCounts, batchSize, seeds, variableValues, 
+                               self.sampler.burnIn)
         
+    def adaptive_marginals(self, variables, evidence=None, targetPrecision=0.01, 
+                           maxSamples=100000, batchSize=100, maxRhat=1.05):
+        """
+            Approximates the joint prior or posterior marginals just like 
+            marginals, but instead of using the fixed burnIn and numSamples,
+            the chains are run until the marginals have converged to the 
+            target precision. The chains are advanced batch by batch and the
+            first half of all samples is treated as burn-in (including the 
+            odd batch, if maxSamples is reached after an odd number of 
+            batches). As soon as 
+            the remaining half of all chains has a split R-hat of at most 
+            maxRhat and the standard error of each estimated probability is 
+            at most targetPrecision, sampling is stopped.
+            All chains are run in this process.
+            
+            Parameters
+            ---------
+            variables : [String,]
+                List containing the names of the desired variables.
+                
+            evidence : dict, optional
+                Dictionary containing the evidence variables as keys and their
+                instantiations as values.
+                
+            targetPrecision : float, optional
+                The desired standard error of the estimated probabilities.
+                (Default: 0.01)
+                
+            maxSamples : int, optional
+                The maximum number of samples drawn by each chain, including
+                the burn-in. Needs to be at least twice the batchSize.
+                (Default: 100000)
+                
+            batchSize : int, optional
+                The number of samples of each chain between the checks for 
+                convergence. (Default: 100)
+                
+            maxRhat : float, optional
+                The largest split R-hat that is considered converged. 
+                (Default: 1.05)
+                
+            Returns
+            -------
+                Factor
+                A factor over the given variables representing their joint 
+                probability given the evidence, pooled over the kept samples 
+                of all chains. diagnostics contains the burn-in and the number
+                of samples per chain that were actually used and its attribute
+                converged tells whether the target precision was reached 
+                before maxSamples.
+        """
+        if maxSamples < 2 * batchSize:
+            raise ValueError("maxSamples needs to be at least twice the batchSize.")
+        if not evidence:
+            evidence = {}
+        variableValues = OrderedDict((v, self.bn.get_node(v).values) for v in variables)
+        seeds = self._chain_seeds()
+        sampler = MarkovChainSampler(self.sampler.transitionModel, 0, self.sampler.fullChange)
+        batches = []
+        nextCheck = 4
+        converged = False
+        for counts in self._chain_batches(sampler, seeds, maxSamples, variables, 
+                                          evidence, variableValues, batchSize):
+            if np.sum(counts[0]) < batchSize:
+                # Partial last batch
+                break
+            batches.append(counts)
+            if len(batches) < nextCheck:
+                continue
+            # Diagnostics are only checked after the number of batches grew
+            # by 10%, so that the checks do not dominate long runs. The 
+            # number of batches at a check is always even, so that exactly
+            # the first half is discarded as burn-in.
+            nextCheck = len(batches) + max(2, len(batches) // 10)
+            nextCheck += nextCheck % 2
+            diagnostics = ChainDiagnostics(np.stack(batches[len(batches)//2:], axis=1), batchSize)
+            if diagnostics.rhat() <= maxRhat and diagnostics.standard_error() <= targetPrecision:
+                converged = True
+                break
+        # If maxSamples ends the chains after an odd number of batches, the
+        # additional batch is added to the burn-in
+        keep = len(batches) // 2
+        res = self._summarize(np.stack(batches[-keep:], axis=1), batchSize, seeds, 
+                              variableValues, (len(batches) - keep) * batchSize)
+        self.diagnostics.converged = converged
         return res
         
+    def _chain_seeds(self):
+        """
+            Draws the seeds of the chains' random number generators from the
+            transition model's generator, or from the random module if the
+            transition model has no generator of its own. Lockstep chains 
+            share one seed.
+        """
+        rng = getattr(self.sampler.transitionModel, "rng", random)
+        if self.lockstep:
+            return [rng.randrange(2**32)] * self.numChains
+        return [rng.randrange(2**32) for chain in range(self.numChains)]
+        
+    def _summarize(self, batchCounts, batchSize, seeds, variableValues, burnIn):
+        """
+            Pools the (chains x batches x query instantiations) counts of all
+            chains into the resulting factor and stores the statistics of 
+            each chain and the diagnostics.
+        """
+        self.chainStatistics = []
+        for chain in range(self.numChains):
+            counts = np.sum(batchCounts[chain], axis=0)
+            numSamples = int(np.sum(counts))
+            self.chainStatistics.append({"seed": seeds[chain], "numSamples": numSamples, 
+                                         "counts": counts,
+                                         "marginals": Factor.from_counts(counts, variableValues)})
+        fullBatches = batchCounts
+        if batchCounts.shape[1] and np.sum(batchCounts[0, -1]) < batchSize:
+            fullBatches = batchCounts[:, :-1]
+        self.diagnostics = ChainDiagnostics(fullBatches, batchSize, burnIn)
+        # Compute probability for variables given the samples
+        return Factor.from_counts(np.sum(batchCounts, axis=(0, 1)), variableValues)
+        
+    def _chain_batches(self, sampler, seeds, numSamples, variables, evidence, 
+                       variableValues, batchSize):
+        """
+            Generator running all chains in this process, batch by batch.
+            
+            Yields
+            -------
+                np.array
+                The (chains x query instantiations) counts of the next batch
+                of each chain, containing batchSize samples per chain except
+                possibly for the last batch.
+        """
+        if not sampler.transitionModel.compiled and not self.lockstep:
+            chains = [sampler.generate_markov_chain(self.bn, numSamples, 
+                                self.bn.get_sample(evidence), evidence)
+                        for chain in range(self.numChains)]
+            for start in range(0, numSamples, batchSize):
+                yield np.array([Factor.count_samples(itertools.islice(chain, batchSize), 
+                                                     variableValues)
+                                    for chain in chains])
+            return
+        
+        network = CompiledNetwork(self.bn)
+        compiledEvidence = network.encode_evidence(evidence)
+        queryIndices = [network.index[v] for v in variables]
+        if not self.lockstep:
+            chains = [_compiled_chain_batches(sampler, seed, network, numSamples, 
+                            compiledEvidence, queryIndices, variableValues, batchSize)
+                        for seed in seeds]
+            for start in range(0, numSamples, batchSize):
+                yield np.array([next(chain) for chain in chains])
+            return
         
+        #Lockstep chains: the counts of all chains are accumulated with one 
+        #np.bincount per sample, using a separate block of flat indices for
+        #each chain.
+        randomState = np.random.RandomState(seeds[0])
+        initialStates = network.sample_forward_batch(compiledEvidence, 
+                                                     self.numChains, randomState)
+        shape = tuple(len(variableValues[v]) for v in variableValues)
+        size = int(np.prod(shape))
+        chainOffsets = np.arange(self.numChains) * size
+        counts = np.zeros(self.numChains * size)
+        filled = 0
+        for states in sampler.generate_lockstep_chains(network, numSamples, 
+                                initialStates, randomState, compiledEvidence):
+            flatIndices = np.ravel_multi_index(tuple(states[:, queryIndices].T), shape)
+            counts += np.bincount(flatIndices + chainOffsets, minlength=len(counts))
+            filled += 1
+            if filled == batchSize:
+                yield counts.reshape((self.numChains,) + shape)
+                counts = np.zeros(self.numChains * size)
+                filled = 0
+        if filled:
+            yield counts.reshape((self.numChains,) + shape)
+        
+    def _pooled_batches(self, sampler, seeds, variables, evidence, variableValues, batchSize):
+        """
+            Runs the compiled chains on a pool of worker processes and returns
+            their (chains x batches x query instantiations) counts.
+        """
+        network = CompiledNetwork(self.bn)
+        compiledEvidence = network.encode_evidence(evidence)
+        queryIndices = [network.index[v] for v in variables]
+        tasks = [(sampler, seed, self.numSamples, compiledEvidence, queryIndices, 
+                  variableValues, batchSize) for seed in seeds]
+        pool = multiprocessing.Pool(min(self.workers, self.numChains),
+                                    initializer=_init_chain_worker,
+                                    initargs=(network,))
+        try:
+            return np.array(pool.map(_run_compiled_chain, tasks))
+        finally:
+            pool.close()
+            pool.join()
     
     
 class MarkovChainSampler(object):
@@ -151,17 +893,136 @@ class MarkovChainSampler(object):
         for i in range(numSamples):
             state = self.transitionModel.step(state, variablesToChange, bn, self.fullChange)
             yield state
+            
+    def generate_lockstep_chains(self, network, numSamples, initialStates, randomState, 
+                                 evidence=None):
+        """
+            Generator yielding the given number of samples of many chains 
+            that are advanced in lockstep on the given compiled network. 
+            Requires a transition model that supports lockstep chains.
+            
+            Parameters
+            ----------
+            network : CompiledNetwork
+                The compiled network from which the samples are drawn.
+                
+            numSamples : int
+                The number of samples of each chain this generator returns
+                
+            initialStates : np.array
+                The (chains x variables) integer coded initial states.
+                
+            randomState : np.random.RandomState
+                The random number generator used for all chains.
+                
+            evidence : dict, optional
+                A dictionary mapping the number of each evidence variable to
+                the index of its observed value.
+            
+            Yields
+            -------
+                np.array
+                The (chains x variables) integer coded current states. The 
+                same array is updated in place by each step, so it needs to
+                be copied if it should be kept.
+        """
+        if not evidence:
+            evidence = {}
+        variablesToChange = [i for i in range(len(network.names)) if i not in evidence]
+        states = np.array(initialStates, dtype=np.intp)
+        if not variablesToChange:
+            for i in range(numSamples):
+                yield states
+            return
+        for i in range(self.burnIn):
+            self.transitionModel.lockstep_step(network, states, variablesToChange, 
+                                               randomState, self.fullChange)
+        for i in range(numSamples):
+            self.transitionModel.lockstep_step(network, states, variablesToChange, 
+                                               randomState, self.fullChange)
+            yield states
+            
+    def generate_compiled_chain(self, network, numSamples, initialState, evidence=None):
+        """
+            Generator yielding the given number of integer coded samples 
+            drawn from the given compiled network starting from the 
+            initialState. Requires a transition model that supports compiled
+            networks.
+            
+            Parameters
+            ----------
+            network : CompiledNetwork
+                The compiled network from which the samples are drawn.
+                
+            numSamples : int
+                The number of samples this generator returns in total
+                
+            initialState : np.array
+                The integer coded initial state of the network.
+                
+            evidence : dict, optional
+                A dictionary mapping the number of each evidence variable to
+                the index of its observed value.
+            
+            Yields
+            -------
+                np.array
+                The integer coded current state. The same array is updated 
+                in place by each step, so it needs to be copied if it should
+                be kept.
+        """
+        if not evidence:
+            evidence = {}
+        variablesToChange = [i for i in range(len(network.names)) if i not in evidence]
+        state = np.array(initialState, dtype=np.intp)
+        if not variablesToChange:
+            for i in range(numSamples):
+                yield state
+            return
+        for i in range(self.burnIn):
+            self.transitionModel.compiled_step(network, state, variablesToChange, self.fullChange)
+        for i in range(numSamples):
+            self.transitionModel.compiled_step(network, state, variablesToChange, self.fullChange)
+            yield state
     
 class TransitionModel(object):
     """
         Abstract class defining a transition model.
+        Transition models that set compiled to True additionally implement 
+        compiled_step, which works on the integer coded states of a 
+        CompiledNetwork and is used instead of step whenever possible.
+        Transition models that set lockstep to True implement lockstep_step,
+        which advances the states of many chains at once.
     """
     
+    compiled = False
+    lockstep = False
+    
+    def __init__(self, seed=None):
+        """
+            Parameters
+            ----------
+            seed : int, optional
+                Seed for the transition model's own random number generator,
+                which is used by compiled_step and for the initial state of
+                compiled chains.
+        """
+        self.rng = random.Random(seed)
+    
     def step(self, currentState, variables, bn, fullChange=False):
         raise NotImplementedError("Should be overwritten by inheriting class.")
+        
+    def compiled_step(self, network, state, variables, fullChange=False):
+        raise NotImplementedError("Should be overwritten by inheriting class.")
+        
+    def lockstep_step(self, network, states, variables, randomState, fullChange=False):
+        raise NotImplementedError("Should be overwritten by inheriting class.")
     
 class GibbsTransition(TransitionModel):
     
+    compiled = True
+    lockstep = True
+    
     def step(self, currentState, variablesToChange, bn, fullChange=False):
         """
             A method that performs "one" markov step according to Gibbs sampling.
@@ -191,10 +1052,94 @@ class GibbsTransition(TransitionModel):
             currentState[varToChange.name] = varToChange.sample_value(currentState, bn.get_children(varToChange.name))
         
         return currentState
+        
+    def compiled_step(self, network, state, variablesToChange, fullChange=False):
+        """
+            Performs "one" markov step according to Gibbs sampling on the 
+            integer coded state of a compiled network, which is updated in
+            place. Each resampled variable only requires computing the 
+            product of the CPDs in its Markov blanket.
+            
+            Parameters
+            ----------
+            network : CompiledNetwork
+                The compiled network that is supposed to be sampled.
+                
+            state : np.array
+                The integer coded current state.
+            
+            variablesToChange : [int,]
+                List containing the numbers of the variables for which a new
+                state needs to be sampled.
+            
+            fullChange: Boolean, optional
+                If True, will create a new sample by sampling all non-evidence
+                variables again. Default: False
+                
+            Returns
+            -------
+                np.array
+                The updated state.
+        """
+        rng = self.rng
+        if not fullChange:
+            variablesToChange = [variablesToChange[int(rng.random() * len(variablesToChange))]]
+        for v in variablesToChange:
+            state[v] = _sample_index(network.markov_weights(state, v), rng)
+        return state
+        
+    def lockstep_step(self, network, states, variablesToChange, randomState, fullChange=False):
+        """
+            Performs "one" markov step according to Gibbs sampling for many
+            chains at once. The states of all chains are updated in place, 
+            where each resampled variable requires one vectorized gather from
+            the CPDs and one categorical draw for all chains.
+            If fullChange is False, the same randomly chosen variable is 
+            resampled in all chains.
+            
+            Parameters
+            ----------
+            network : CompiledNetwork
+                The compiled network that is supposed to be sampled.
+                
+            states : np.array
+                The (chains x variables) integer coded current states.
+            
+            variablesToChange : [int,]
+                List containing the numbers of the variables for which a new
+                state needs to be sampled.
+                
+            randomState : np.random.RandomState
+                The random number generator used for all chains.
+            
+            fullChange: Boolean, optional
+                If True, will create a new sample by sampling all non-evidence
+                variables again. Default: False
+                
+            Returns
+            -------
+                np.array
+                The updated states.
+        """
+        if not fullChange:
+            variablesToChange = [variablesToChange[randomState.randint(len(variablesToChange))]]
+        for v in variablesToChange:
+            states[:, v] = _sample_indices(network.markov_weights_batch(states, v), randomState)
+        return states
 
     
 class MetropolisHastingsTransition(TransitionModel):
     
+    compiled = True
+    
+    def __init__(self, seed=None):
+        super(MetropolisHastingsTransition, self).__init__(seed)
+        #Cached CPD entries and values of the state last used by compiled_step
+        self._cachedState = None
+        self._cachedNetwork = None
+        self._cachedTerms = None
+        self._cachedValues = None
+    
     def step(self, currentState, variablesToChange, bn, fullChange = False):
         """
             A method that performs "one" markov step according to MetropolisHasting sampling.
@@ -216,29 +1161,86 @@ class MetropolisHastingsTransition(TransitionModel):
                 If True, will create a new sample by sampling all non-evidence
                 variables again. Default: False
         """
-        if fullChange:
-            for v in variablesToChange:
-                proposedValue = v.sample_local(currentState[v.name])
-                adoptedState = dict(currentState)
-                adoptedState[v.name] = proposedValue
-                proposedProb = v.get_markov_prob(proposedValue, bn.get_children(v.name), adoptedState)
-                currentProb = v.get_markov_prob(currentState[v.name], bn.get_children(v.name), currentState)
-                
-                accept = min(1.0, proposedProb/currentProb)
-                if random.random() <= accept:
-                    currentState[v.name] = proposedValue
-        else:
-            varToChange = random.choice(variablesToChange)
-            proposedValue = varToChange.sample_local(currentState[varToChange])
-            adoptedState = dict(currentState)
-            adoptedState[varToChange.name] = proposedValue
-            proposedProb = varToChange.get_markov_prob(proposedValue, bn.get_children(varToChange), adoptedState)
-            currentProb = varToChange.get_markov_prob(currentState[varToChange], bn.get_children(varToChange), currentState)
-            
-            accept = min(1.0, proposedProb/currentProb)
+        if not fullChange:
+            variablesToChange = [random.choice(variablesToChange)]
+        for v in variablesToChange:
+            children = bn.get_children(v.name)
+            currentValue = currentState[v.name]
+            currentProb = v.get_markov_prob(currentValue, children, currentState)
+            # The proposal is evaluated in place and reverted if rejected
+            proposedValue = v.sample_local(currentValue)
+            currentState[v.name] = proposedValue
+            proposedProb = v.get_markov_prob(proposedValue, children, currentState)
             
-            if random.random() <= accept:
-                currentState[varToChange.name] = proposedValue
+            accept = min(1.0, proposedProb/currentProb) if currentProb > 0 else 1.0
+            if random.random() > accept:
+                currentState[v.name] = currentValue
             
         return currentState
-            
\ No newline at end of file
+        
+    def compiled_step(self, network, state, variablesToChange, fullChange=False):
+        """
+            Performs "one" markov step according to MetropolisHasting sampling
+            on the integer coded state of a compiled network, which is updated
+            in place. The CPD entries of all variables for the current state
+            are cached, so that the probability of the current value given the
+            Markov blanket is just the product of cached terms. Only the terms
+            for the proposed value are looked up (as single entries, see 
+            CompiledNetwork.scalar_terms) and on acceptance they replace the
+            cached terms of the variable and its children.
+            The cache is bound to the given state array, which therefore 
+            must not be modified other than by this method.
+            
+            Parameters
+            ----------
+            network : CompiledNetwork
+                The compiled network that is supposed to be sampled.
+                
+            state : np.array
+                The integer coded current state.
+            
+            variablesToChange : [int,]
+                List containing the numbers of the variables for which a new
+                state needs to be sampled.
+            
+            fullChange: Boolean, optional
+                If True, will create a new sample by sampling all non-evidence
+                variables again. Default: False
+                
+            Returns
+            -------
+                np.array
+                The updated state.
+        """
+        if self._cachedState is not state or self._cachedNetwork is not network:
+            self._cachedState = state
+            self._cachedNetwork = network
+            self._cachedTerms = network.cpd_terms(state).tolist()
+            self._cachedValues = state.tolist()
+        cachedTerms = self._cachedTerms
+        values = self._cachedValues
+        scalarTerms, cpds = network.scalar_terms()
+        rng = self.rng
+        if not fullChange:
+            variablesToChange = [variablesToChange[int(rng.random() * len(variablesToChange))]]
+        for v in variablesToChange:
+            terms = scalarTerms[v]
+            proposedValue = int(rng.random() * len(network.values[v]))
+            proposedTerms = []
+            currentProb = 1.0
+            proposedProb = 1.0
+            for t, offset, stride, rest in terms:
+                index = offset + stride * proposedValue
+                for u, s in rest:
+                    index += values[u] * s
+                proposedTerms.append(cpds[index])
+                proposedProb *= cpds[index]
+                currentProb *= cachedTerms[t]
+            
+            accept = min(1.0, proposedProb/currentProb) if currentProb > 0 else 1.0
+            if rng.random() <= accept:
+                state[v] = proposedValue
+                values[v] = proposedValue
+                for (t, _, _, _), p in zip(terms, proposedTerms):
+                    cachedTerms[t] = p
+        return state
@@ -19,10 +19,88 @@
 # License along with this program.  If not, see
 # <http://www.gnu.org/licenses/>.
 
-from operator import itemgetter
+import hashlib
+import heapq
+import json
+import math
+import os
+import random
+import tempfile
+import time
 
 from ..networks import BayesianNetwork
 
+def _degree(adjacency, cardinalities, variable):
+    """
+        Number of neighbours of the variable in the interaction graph.
+    """
+    return len(adjacency[variable])
+
+def _fill(adjacency, cardinalities, variable):
+    """
+        Number of edges that need to be added between the variable's
+        neighbours when eliminating it.
+    """
+    neighbors = list(adjacency[variable])
+    fill = 0
+    for i, n in enumerate(neighbors):
+        for n2 in neighbors[i+1:]:
+            if n2 not in adjacency[n]:
+                fill += 1
+    return fill
+
+def _weighted_fill(adjacency, cardinalities, variable):
+    """
+        Sum of the weights of the edges that need to be added between the
+        variable's neighbours when eliminating it, where the weight of an edge
+        is the product of the number of states of its end points.
+    """
+    neighbors = list(adjacency[variable])
+    fill = 0
+    for i, n in enumerate(neighbors):
+        for n2 in neighbors[i+1:]:
+            if n2 not in adjacency[n]:
+                fill += cardinalities[n] * cardinalities[n2]
+    return fill
+
+_HEURISTICS = {"min_degree": _degree, 
+               "min_fill": _fill, 
+               "weighted_min_fill": _weighted_fill}
+
+#Best orders found by Orderer.optimize, keyed by the structure hash of the
+#network
+_orderCache = {}
+
+def _read_cache(cacheFile):
+    """
+        Returns the orders stored in the given cache file, or an empty dict
+        if the file does not exist or cannot be parsed.
+    """
+    try:
+        with open(cacheFile) as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+def _write_cache(cacheFile, cache):
+    """
+        Writes the given orders to a temporary file in the directory of the
+        cache file and moves it into place, so that concurrent processes 
+        never read a partially written cache.
+    """
+    handle, tempPath = tempfile.mkstemp(suffix=".tmp", 
+                            dir=os.path.dirname(os.path.abspath(cacheFile)))
+    try:
+        with os.fdopen(handle, "w") as f:
+            json.dump(cache, f)
+        # os.replace does not exist in Python 2, where os.rename replaces
+        # existing files on POSIX systems
+        getattr(os, "replace", os.rename)(tempPath, cacheFile)
+    except BaseException:
+        os.remove(tempPath)
+        raise
+
 class Orderer(object):
     """
         A "static" class that provides the functionality to create elimination orders
@@ -47,41 +125,310 @@ class Orderer(object):
                 A list of variable names, representing the elimination order of 
                 these variables.
         """
+        return Orderer.get_heuristic_order(bn, "min_degree")[0]
+
+    @staticmethod
+    def get_heuristic_order(bn, heuristic="min_degree"):
+        """
+            Returns the elimination order that greedily eliminates the variable
+            with the lowest score according to the given heuristic (see 
+            "Modeling and Reasoning with Bayesian Networks" - Adnan Darwiche
+            Chapter 6.6 and "Probabilistic Graphical Models" - Koller and
+            Friedman Chapter 9.4.3), together with the size of the clusters
+            this order induces.
+            The scores are kept in a priority queue and only updated for the
+            variables that are affected by an elimination. Ties are broken 
+            by the variable names, so the order is deterministic.
+            
+            Parameter
+            ---------
+            bn : BayesianNetwork
+                The network for which the order is to be determined.
+            heuristic : String, optional
+                One of "min_degree" (number of neighbours), "min_fill" (number
+                of fill-in edges) or "weighted_min_fill" (fill-in edges 
+                weighted by the product of the number of states of their 
+                end points). Defaults to "min_degree".
+                
+            Returns
+            -------
+                [String,], int, int
+                A list of variable names, representing the elimination order of 
+                these variables, the induced width of that order (i.e. the
+                number of variables in the largest cluster minus 1) and the
+                number of entries of the largest cluster's table.
+        """
+        if not isinstance(bn, BayesianNetwork):
+            raise TypeError("Only Bayesian Networks are currently supported.")
+        if heuristic not in _HEURISTICS:
+            raise ValueError("Unknown heuristic {}. Supported heuristics are {}."
+                             .format(heuristic, sorted(_HEURISTICS)))
+        score = _HEURISTICS[heuristic]
+        
+        adjacency = Orderer._interaction_graph(bn)
+        cardinalities = {n.name: len(n.values) for n in bn.get_all_nodes()}
+        return Orderer._greedy_order(adjacency, cardinalities, score)[:3]
+
+    @staticmethod
+    def get_order_cost(bn, order):
+        """
+            Determines the size of the clusters that eliminating the
+            variables of the network in the given order induces.
+            
+            Parameter
+            ---------
+            bn : BayesianNetwork
+                The network the order is meant for.
+            order : [String,]
+                The elimination order containing all variables of the network.
+                
+            Returns
+            -------
+                int, int, int
+                The induced width of the order, the number of entries of the
+                largest cluster's table and the total number of entries of all
+                cluster tables.
+        """
+        if not isinstance(bn, BayesianNetwork):
+            raise TypeError("Only Bayesian Networks are currently supported.")
+        adjacency = Orderer._interaction_graph(bn)
+        if len(order) != len(adjacency) or set(order) != set(adjacency):
+            raise ValueError("The order needs to contain each variable of the " \
+                             "network exactly once.")
+        cardinalities = {n.name: len(n.values) for n in bn.get_all_nodes()}
+        return Orderer._order_cost(adjacency, cardinalities, order)
+
+    @staticmethod
+    def optimize(bn, budgetSeconds=1.0, anneal=False, seed=None, 
+                 useCache=True, cacheFile=None):
+        """
+            Searches for an elimination order with a small total table size
+            of the induced clusters, which is roughly the time and memory 
+            required for inference with this order.
+            All greedy heuristics of get_heuristic_order are tried first, 
+            followed by restarts of randomized min-fill and weighted min-fill
+            (breaking ties randomly) until the time budget is used up. If 
+            anneal is set, half of the budget is instead spent on simulated
+            annealing of the best order found, by swapping pairs of variables.
+            
+            The result is cached by the structure of the network (its 
+            variables, their number of states and their parents), so that
+            searching again for the same structure returns immediately.
+            
+            Parameter
+            ---------
+            bn : BayesianNetwork
+                The network for which the order is to be determined.
+            budgetSeconds : float, optional
+                The time that may be spent on the randomized search. The
+                greedy heuristics are always evaluated. Defaults to 1 second.
+            anneal : bool, optional
+                If set to True, the best order is improved by simulated 
+                annealing. Defaults to False.
+            seed : int, optional
+                Seed for the randomized search.
+            useCache : bool, optional
+                If set to False, cached orders are ignored and the search is
+                always performed (its result is still cached). Defaults to True.
+            cacheFile : String, optional
+                Path of a JSON file that persists the cache across processes.
+                It is created if it does not exist yet and replaced 
+                atomically, while an unreadable file is treated as empty.
+                
+            Returns
+            -------
+                [String,]
+                A list of variable names, representing the best elimination 
+                order found.
+        """
         if not isinstance(bn, BayesianNetwork):
             raise TypeError("Only Bayesian Networks are currently supported.")
+        key = Orderer.get_structure_hash(bn)
+        if cacheFile:
+            _orderCache.update(_read_cache(cacheFile))
+        if useCache and key in _orderCache:
+            return list(_orderCache[key]["order"])
+        
+        start = time.time()
+        rng = random.Random(seed)
+        adjacency = Orderer._interaction_graph(bn)
+        cardinalities = {n.name: len(n.values) for n in bn.get_all_nodes()}
+        bestOrder, bestCost = None, None
+        for heuristic in sorted(_HEURISTICS):
+            order, _, _, cost = Orderer._greedy_order(
+                                        {v: set(a) for v, a in adjacency.items()},
+                                        cardinalities, _HEURISTICS[heuristic])
+            if bestCost is None or cost < bestCost:
+                bestOrder, bestCost = order, cost
+        
+        restartBudget = budgetSeconds / 2 if anneal else budgetSeconds
+        while time.time() - start < restartBudget:
+            score = rng.choice([_fill, _weighted_fill])
+            order, _, _, cost = Orderer._greedy_order(
+                                        {v: set(a) for v, a in adjacency.items()},
+                                        cardinalities, score, rng)
+            if cost < bestCost:
+                bestOrder, bestCost = order, cost
+        
+        if anneal and len(bestOrder) > 1:
+            bestOrder, bestCost = Orderer._anneal(adjacency, cardinalities,
+                                        bestOrder, bestCost, rng,
+                                        start + budgetSeconds)
         
-        interactionG = bn.graph.to_undirected()
-        res = []        
-        for i in range(len(bn.get_all_node_names())):
-            degrees = dict(interactionG.degree())
-            varToElim = sorted(degrees.items(), key=itemgetter(1))[0][0]
-            res.append(varToElim.name)
-            for p in interactionG[varToElim]:#.parents:
-                for p2 in interactionG[varToElim]:#varToElim.parents:
-                    if p != p2 and not p2 in interactionG[p]:#:
-#                        interactionG.add_edge(varToElim.parents[p], varToElim.parents[p2])
-                        interactionG.add_edge(p,p2)
-            interactionG.remove_node(varToElim)
-#        succs = copy.copy(bn.graph.succ)
-#        preds = copy.copy(bn.graph.pred)
-#        adjs = {n: list(succs[n])+list(preds[n]) for n in succs.keys()}
-#        print adjs
-#        
-#        variables = bn.get_all_node_names()
-#        res = []
-#        for i in range(len(variables)):
-#            degrees = {n: len(adjs) for n in adjs.keys()}
-#            varToElim = sorted(degrees.items(), key=itemgetter(1))[0][0]
-#            res.append(varToElim.name)
-#            del degrees[varToElim]
-#            for neigh1 in adjs[varToElim]:
-#                for neigh2 in adjs[varToElim]:
-#                    if neigh1 != neigh2:
-#                        if neigh1 not in adjs[neigh2]:
-#                            adjs[neigh1].append(neigh2)
-#                            adjs[neigh2].append(neigh1)
-#            del adjs[varToElim]
-        return res
+        _orderCache[key] = {"order": bestOrder, "cost": bestCost}
+        if cacheFile:
+            _write_cache(cacheFile, _orderCache)
+        return list(bestOrder)
+
+    @staticmethod
+    def get_structure_hash(bn):
+        """
+            Returns a hash of the network's structure, i.e. its variables,
+            their number of states and their parents, which does not depend
+            on the order the nodes were added in or on the CPDs.
+            
+            Returns
+            -------
+                String
+                The hexadecimal SHA-1 digest of the structure.
+        """
+        structure = sorted((n.name, len(n.values), sorted(n.parentOrder))
+                                for n in bn.get_all_nodes())
+        return hashlib.sha1(repr(structure).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _greedy_order(adjacency, cardinalities, score, rng=None):
+        """
+            Greedily eliminates the variable with the lowest score from the
+            interaction graph given as adjacency sets, which is consumed.
+            Ties are broken by the variable names or randomly if a random
+            number generator is given.
+            
+            Returns
+            -------
+                [String,], int, int, int
+                The order, its induced width, the largest and the total 
+                number of entries of the cluster tables.
+        """
+        scores = {v: score(adjacency, cardinalities, v) for v in adjacency}
+        tie = (lambda v: v) if rng is None else (lambda v: rng.random())
+        heap = [(s, tie(v), v) for v, s in scores.items()]
+        heapq.heapify(heap)
+        res = []
+        inducedWidth = 0
+        maxCliqueSize = 0
+        totalSize = 0
+        while heap:
+            s, _, varToElim = heapq.heappop(heap)
+            # Skip outdated entries of variables whose score has changed
+            if scores.get(varToElim) != s:
+                continue
+            del scores[varToElim]
+            res.append(varToElim)
+            neighbors = Orderer._eliminate(adjacency, varToElim)
+            inducedWidth = max(inducedWidth, len(neighbors))
+            cliqueSize = cardinalities[varToElim]
+            for n in neighbors:
+                cliqueSize *= cardinalities[n]
+            maxCliqueSize = max(maxCliqueSize, cliqueSize)
+            totalSize += cliqueSize
+            
+            # The degree only changes for the neighbours, while the fill-in 
+            # edges also change for all variables adjacent to them
+            affected = set(neighbors)
+            if score is not _degree:
+                for n in neighbors:
+                    affected.update(adjacency[n])
+            for n in affected:
+                newScore = score(adjacency, cardinalities, n)
+                if newScore != scores[n]:
+                    scores[n] = newScore
+                    heapq.heappush(heap, (newScore, tie(n), n))
+        return res, inducedWidth, maxCliqueSize, totalSize
+
+    @staticmethod
+    def _order_cost(adjacency, cardinalities, order):
+        """
+            Eliminates the variables in the given order from a copy of the
+            interaction graph and returns the induced width, the largest and
+            the total number of entries of the cluster tables.
+        """
+        adjacency = {v: set(a) for v, a in adjacency.items()}
+        inducedWidth = 0
+        maxCliqueSize = 0
+        totalSize = 0
+        for v in order:
+            neighbors = Orderer._eliminate(adjacency, v)
+            inducedWidth = max(inducedWidth, len(neighbors))
+            cliqueSize = cardinalities[v]
+            for n in neighbors:
+                cliqueSize *= cardinalities[n]
+            maxCliqueSize = max(maxCliqueSize, cliqueSize)
+            totalSize += cliqueSize
+        return inducedWidth, maxCliqueSize, totalSize
+
+    @staticmethod
+    def _anneal(adjacency, cardinalities, order, cost, rng, deadline):
+        """
+            Improves the given order by simulated annealing until the deadline
+            is reached. Neighbouring orders differ by the swap of two 
+            variables and are accepted according to the change in the 
+            logarithm of their total table size.
+            
+            Returns
+            -------
+                [String,], int
+                The best order found and its total table size.
+        """
+        bestOrder, bestCost = list(order), cost
+        current, currentCost = list(order), cost
+        temperature = 1.0
+        while time.time() < deadline:
+            i, j = rng.sample(range(len(current)), 2)
+            current[i], current[j] = current[j], current[i]
+            newCost = Orderer._order_cost(adjacency, cardinalities, current)[2]
+            delta = math.log(newCost) - math.log(currentCost)
+            if delta <= 0 or rng.random() < math.exp(-delta / temperature):
+                currentCost = newCost
+                if newCost < bestCost:
+                    bestOrder, bestCost = list(current), newCost
+            else:
+                current[i], current[j] = current[j], current[i]
+            temperature = max(temperature * 0.99, 1e-3)
+        return bestOrder, bestCost
+
+    @staticmethod
+    def _interaction_graph(bn):
+        """
+            Returns the interaction graph of the network's CPDs (i.e. its
+            moral graph) as dictionary of adjacency sets over the variable
+            names.
+        """
+        adjacency = {n.name: set() for n in bn.get_all_nodes()}
+        for n in bn.get_all_nodes():
+            family = [n.name] + list(n.parentOrder)
+            for v in family:
+                adjacency[v].update(family)
+                adjacency[v].discard(v)
+        return adjacency
+
+    @staticmethod
+    def _eliminate(adjacency, variable):
+        """
+            Removes the given variable from the interaction graph given as
+            adjacency sets after connecting all its neighbours.
+            
+            Returns
+            -------
+                set(String,)
+                The neighbours of the eliminated variable.
+        """
+        neighbors = adjacency.pop(variable)
+        for n in neighbors:
+            adjacency[n].discard(variable)
+            adjacency[n].update(neighbors)
+            adjacency[n].discard(n)
+        return neighbors
 
     @staticmethod
     def get_random_order(bn):
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# This file is part of PRIMO2 -- Probabilistic Inference Modules.
+# Copyright (C) 2013-2017 Social Cognitive Systems Group,
+#                         Faculty of Technology, Bielefeld University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the Lesser GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program.  If not, see
+# <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+from ..networks import BayesianNetwork
+from ..nodes import DiscreteNode
+
+class Pruner(object):
+    """
+        A "static" class that provides the functionality to prune Bayesian
+        networks to the part that is relevant for a given query, following
+        "Modeling and Reasoning with Bayesian Networks" - Adnan Darwiche
+        Chapter 6.9
+    """
+
+    @staticmethod
+    def prune_network(bn, variables, evidence=None):
+        """
+            Prunes the network for the given query. This removes all barren
+            nodes (nodes that are neither query nor evidence variables nor
+            ancestors of them), removes the edges going out of variables with
+            hard evidence (restricting the children's CPDs to the observed
+            value) and finally removes all parts of the network that are not
+            connected to any query variable anymore.
+            The posterior marginals of the query variables in the pruned
+            network are the same as in the original network. The original
+            network is not modified.
+
+            Parameter
+            ---------
+            bn : BayesianNetwork
+                The network that is supposed to be queried.
+            variables : [String,]
+                List containing the names of the query variables.
+            evidence : dict, optional
+                Dictionary containing the given evidence in the same format as
+                for the inference algorithms.
+
+            Returns
+            -------
+                BayesianNetwork, dict
+                The pruned network and the evidence for the variables that
+                are still contained in it.
+        """
+        if not isinstance(bn, BayesianNetwork):
+            raise TypeError("Only Bayesian Networks are currently supported.")
+        if not evidence:
+            evidence = {}
+        relevant = Pruner.get_ancestral_set(bn, list(variables) + list(evidence))
+
+        # Only hard evidence allows to cut edges
+        observed = {}
+        for e in evidence:
+            if not isinstance(evidence[e], np.ndarray):
+                values = bn.get_node(e).values
+                if not evidence[e] in values:
+                    raise ValueError("Evidence {} is not one of the possible " \
+                                     "values ({}) for this variable."
+                                     .format(evidence[e], values))
+                observed[e] = values.index(evidence[e])
+
+        # Keep the parts connected to the query variables without using
+        # the cut edges
+        keep = set()
+        stack = list(variables)
+        while stack:
+            v = stack.pop()
+            if v in keep:
+                continue
+            keep.add(v)
+            node = bn.get_node(v)
+            if v not in observed:
+                stack.extend(c.name for c in bn.get_children(v) if c.name in relevant)
+            stack.extend(p for p in node.parentOrder if p not in observed)
+
+        prunedBn = Pruner.get_subnetwork(bn, keep, observed)
+        return prunedBn, {e: evidence[e] for e in evidence if e in keep}
+
+    @staticmethod
+    def get_ancestral_set(bn, variables):
+        """
+            Returns the given variables together with all their ancestors.
+            All other nodes are barren for a query on these variables.
+
+            Parameter
+            ---------
+            bn : BayesianNetwork
+                The network containing the variables.
+            variables : [String,]
+                List containing the names of the variables, e.g. the query and
+                evidence variables.
+
+            Returns
+            -------
+                set(String,)
+                The names of all variables of the ancestral set.
+        """
+        res = set()
+        stack = list(variables)
+        while stack:
+            v = stack.pop()
+            if v not in res:
+                res.add(v)
+                stack.extend(bn.get_node(v).parentOrder)
+        return res
+
+    @staticmethod
+    def get_subnetwork(bn, variables, observed=None):
+        """
+            Creates a copy of the network restricted to the given variables.
+            Parents of a variable that are not given or that are observed are
+            removed and the variable's CPD is restricted accordingly.
+
+            Parameter
+            ---------
+            bn : BayesianNetwork
+                The network to copy from.
+            variables : set(String,)
+                The names of the variables to be contained. All parents of
+                these variables need to be contained as well, unless they are
+                observed.
+            observed : dict, optional
+                Dictionary containing the index of the observed value of
+                variables with hard evidence, whose outgoing edges are removed.
+
+            Returns
+            -------
+                BayesianNetwork
+                The new network.
+        """
+        if not observed:
+            observed = {}
+        res = BayesianNetwork()
+        res.name = bn.name
+        for v in sorted(variables):
+            res.add_node(DiscreteNode(v, bn.get_node(v).values))
+        for v in sorted(variables):
+            node = bn.get_node(v)
+            index = [slice(None)]
+            for p in node.parentOrder:
+                if p in observed:
+                    index.append(observed[p])
+                elif p in variables:
+                    index.append(slice(None))
+                    res.add_edge(p, v)
+                else:
+                    raise ValueError("The parent {} of {} is neither contained " \
+                                     "nor observed.".format(p, v))
+            res.get_node(v).set_cpd(node.cpd[tuple(index)])
+        return res
@@ -88,6 +88,55 @@ class FactorTest(unittest.TestCase):
         self.assertEqual(res.get_potential({"A":["True"], "B":["False"]}), 0.25)
         self.assertEqual(res.get_potential({"A":["False"], "B":["False"]}), 0.25)
         
+    def test_create_from_samples_generator(self):
+        from collections import OrderedDict
+        def generator():
+            # The same dictionary is reused for every sample
+            state = {"A": "True", "B": "True"}
+            for a, b in [("True", "True"), ("True", "False"), ("False", "False"), ("True", "True")]:
+                state["A"] = a
+                state["B"] = b
+                yield state
+        variableValues = OrderedDict()
+        variableValues["A"] = ["True","False"]
+        variableValues["B"] = ["True","False"]
+        res = Factor.from_samples(generator(), variableValues, chunkSize=3)
+        np.testing.assert_array_almost_equal(res.potentials, np.array([[0.5, 0.25], [0, 0.25]]))
+        res = Factor.from_samples(generator(), {"B": ["True","False"]})
+        np.testing.assert_array_almost_equal(res.potentials, np.array([0.5, 0.5]))
+        with self.assertRaises(ValueError) as cm:
+            Factor.from_samples([{"A": "Maybe"}], {"A": ["True","False"]})
+        self.assertEqual(str(cm.exception), "The sampled value Maybe is not one of "\
+                         "the possible values (['True', 'False']) for variable A.")
+        
+    def test_create_from_samples_mixed_types(self):
+        from collections import OrderedDict
+        variableValues = OrderedDict()
+        variableValues["A"] = [1, 2]
+        variableValues["B"] = ["x", "y"]
+        samples = [{"A": 1, "B": "x"}, {"A": 2, "B": "x"}, {"A": 1, "B": "x"}, {"A": 1, "B": "y"}]
+        res = Factor.from_samples(samples, variableValues)
+        np.testing.assert_array_almost_equal(res.potentials, np.array([[0.5, 0.25], [0.25, 0]]))
+        
+    def test_create_from_coded_samples(self):
+        from collections import OrderedDict
+        variableValues = OrderedDict()
+        variableValues["A"] = ["True","False"]
+        variableValues["B"] = ["x", "y", "z"]
+        samples = [{"A":"True", "B":"z"}, {"A":"False", "B":"x"}, {"A":"True", "B":"z"}]
+        codes = Factor.encode_samples(samples, variableValues)
+        np.testing.assert_array_equal(codes, np.array([[0, 2], [1, 0], [0, 2]]))
+        res = Factor.from_samples(codes, variableValues)
+        np.testing.assert_array_almost_equal(res.potentials, 
+                                             np.array([[0, 0, 2/3], [1/3, 0, 0]]))
+        # Counts can be accumulated online
+        counts = Factor.count_samples(codes, variableValues)
+        Factor.count_samples(samples[:1], variableValues, counts=counts)
+        np.testing.assert_array_equal(counts, np.array([[0, 0, 3], [1, 0, 0]]))
+        res = Factor.from_counts(counts, variableValues)
+        self.assertEqual(res.variableOrder, ["A", "B"])
+        np.testing.assert_array_almost_equal(res.potentials, counts / 4)
+        
     def test_as_evidence(self):
         f = Factor.as_evidence("E", ["True","False"], "True")
         np.testing.assert_array_almost_equal(f.potentials, np.array([1.0,0.0]))
@@ -251,8 +300,63 @@ class FactorTest(unittest.TestCase):
             self.assertTrue(v in fRes.values[self.n3])    
         
         # TODO Ensure that multiplication is commutative
-#        fRes2 = f3 * f2 
+#        fRes2 = f3 * f2
 #        np.testing.assert_array_equal(fRes2.potentials, res)
+
+    def test_multiplication_reuses_broadcast_plan(self):
+        from primo2.inference import factor
+        f1 = Factor.from_node(self.n1)
+        f2 = Factor.from_node(self.n2)
+        f3 = f1 * f2
+        plan = factor._get_broadcast_plan(f1.variableOrder, f2.variableOrder)
+        self.assertEqual(plan.variableOrder, ("Node1", "Node2"))
+        self.assertTrue(plan is factor._get_broadcast_plan(f1.variableOrder, f2.variableOrder))
+        f4 = f1 * f2
+        np.testing.assert_array_almost_equal(f3.potentials, f4.potentials)
+        self.assertEqual(f4.variableOrder, ["Node1", "Node2"])
+        # Neither operand may be modified by the product
+        np.testing.assert_array_almost_equal(f2.potentials, self.n2.cpd)
+        self.assertEqual(f2.variableOrder, ["Node2", "Node1"])
+
+    def test_addition_different_vars(self):
+        f1 = Factor.from_node(self.n1)
+        f2 = Factor.from_node(self.n2)
+        fRes = f1 + f2
+        np.testing.assert_array_almost_equal(fRes.potentials,
+                                             self.n1.cpd[:,np.newaxis] + self.n2.cpd.T)
+        self.assertEqual(fRes.variableOrder, ["Node1", "Node2"])
+
+    def test_inplace_multiplication(self):
+        f1 = Factor.from_node(self.n1)
+        f2 = Factor.from_node(self.n2)
+        potentials = f2.potentials
+        f2 *= f1
+        self.assertTrue(f2.potentials is potentials)
+        self.assertEqual(f2.variableOrder, ["Node2", "Node1"])
+        np.testing.assert_array_almost_equal(f2.potentials, 
+                        np.array([[0.06, 0.28], [0.12, 0.07], [0.12, 0.35]]))
+        
+    def test_inplace_multiplication_new_variables(self):
+        f1 = Factor.from_node(self.n1)
+        f2 = Factor.from_node(self.n2)
+        f1 *= f2
+        np.testing.assert_array_almost_equal(f1.potentials, 
+                        np.array([[0.06, 0.12, 0.12], [0.28, 0.07, 0.35]]))
+        
+    def test_inplace_division(self):
+        f1 = Factor()
+        f1.variableOrder = ["a","b"]
+        f1.values = {"a":["a1","a2","a3"], "b":["b1","b2"]}
+        f1.potentials = np.array([[0.5,0.2],[0,0],[0.3,0.45]])
+        potentials = f1.potentials
+        f2 = Factor()
+        f2.variableOrder = ["a"]
+        f2.values = {"a":["a1","a2","a3"]}
+        f2.potentials = np.array([0.8,0,0.6])
+        f1 /= f2
+        self.assertTrue(f1.potentials is potentials)
+        np.testing.assert_array_almost_equal(f1.potentials, 
+                        np.array([[0.625, 0.25],[0,0],[0.5,0.75]]))
         
     def test_marginalisation(self):
         f1 = Factor.from_node(self.n1)
@@ -288,6 +392,108 @@ class FactorTest(unittest.TestCase):
         self.assertFalse(self.n1 in fRes)
         self.assertFalse(self.n1 in fRes.values)
         
+    def test_marginalize_into(self):
+        f1 = Factor.from_node(self.n1)
+        f2 = Factor.from_node(self.n2)
+        f3 = f1 * f2
+        out = Factor.zero_factor(["Node2"], {"Node2": self.n2.values})
+        potentials = out.potentials
+        res = f3.marginalize_into("Node1", out)
+        self.assertTrue(res is out)
+        self.assertTrue(out.potentials is potentials)
+        np.testing.assert_array_almost_equal(out.potentials, np.array([0.34, 0.19, 0.47]))
+        
+    def test_marginalize_into_different_order(self):
+        f = Factor.from_node(self.n2) * Factor.from_node(self.n3)
+        out = Factor.zero_factor(["Node3", "Node2"], 
+                                 {"Node2": self.n2.values, "Node3": self.n3.values})
+        f.marginalize_into(["Node1"], out)
+        np.testing.assert_array_almost_equal(out.potentials, 
+                        f.marginalize("Node1").potentials.T)
+        with self.assertRaises(ValueError):
+            f.marginalize_into(["Node1", "Node2"], out)
+
+    def test_product_marginalize(self):
+        factors = [Factor.from_node(self.n1), Factor.from_node(self.n2),
+                   Factor.from_node(self.n3)]
+        factors[2].logScale = 0.5
+        full = factors[0] * factors[1] * factors[2]
+        res = Factor.product_marginalize(factors, ["Node3", "Node2"])
+        self.assertEqual(res.variableOrder, ["Node3", "Node2"])
+        np.testing.assert_array_almost_equal(res.potentials,
+                        full.marginalize("Node1").potentials.T)
+        self.assertAlmostEqual(res.logScale, 0.5)
+        res = Factor.product_marginalize(factors, [])
+        self.assertAlmostEqual(res.potentials, 1.0)
+        # The given factors are not modified
+        np.testing.assert_array_equal(factors[0].potentials, self.n1.cpd)
+        res = Factor.product_marginalize(factors[:1], ["Node1"])
+        res.normalize()
+        res.potentials[0] = 0
+        np.testing.assert_array_equal(factors[0].potentials, self.n1.cpd)
+
+    def test_product_marginalize_out(self):
+        factors = [Factor.from_node(self.n1), Factor.from_node(self.n2)]
+        out = Factor.zero_factor(["Node2"], {"Node2": self.n2.values})
+        potentials = out.potentials
+        res = Factor.product_marginalize(factors, ["Node2"], out=out)
+        self.assertTrue(res is out)
+        self.assertTrue(out.potentials is potentials)
+        np.testing.assert_array_almost_equal(out.potentials, np.array([0.34, 0.19, 0.47]))
+        with self.assertRaises(ValueError):
+            Factor.product_marginalize(factors, ["Node1"], out=out)
+        with self.assertRaises(ValueError):
+            Factor.product_marginalize(factors, ["Node3"])
+
+    def test_product_marginalize_many_variables(self):
+        # A chain over more variables than np.einsum supports subscripts
+        transition = np.array([[0.9, 0.1], [0.2, 0.8]])
+        names = ["X{}".format(i) for i in range(60)]
+        values = {v: ["a", "b"] for v in names}
+        factors = []
+        for first, second in zip(names, names[1:]):
+            f = Factor.unit_factor([first, second], values)
+            f.potentials = transition.copy()
+            factors.append(f)
+        res = Factor.product_marginalize(factors, ["X59", "X0"])
+        self.assertEqual(res.variableOrder, ["X59", "X0"])
+        np.testing.assert_array_almost_equal(res.potentials, 
+                        np.linalg.matrix_power(transition, 59).T)
+        # Intermediate factors can still not exceed the limit of np.einsum
+        values = {v: ["a"] for v in names}
+        factors = [Factor.unit_factor(names[:30], values), 
+                   Factor.unit_factor(names[30:], values)]
+        with self.assertRaises(ValueError) as cm:
+            Factor.product_marginalize(factors, names)
+        self.assertEqual(str(cm.exception), "The product requires an intermediate " \
+                         "factor over more than 52 variables.")
+        
+    def test_rescale(self):
+        f = Factor.from_node(self.n1) * Factor.from_node(self.n2)
+        expected = f.potentials * 1e-200
+        f.potentials *= 1e-200
+        f.rescale()
+        self.assertAlmostEqual(np.sum(f.potentials), 1.0)
+        np.testing.assert_array_almost_equal(np.exp(f.logScale) * f.potentials / 1e-200,
+                                             expected / 1e-200)
+        self.assertAlmostEqual(f.get_log_sum(), np.log(1e-200))
+        # Scales are multiplied along with the potentials
+        res = f * f.marginalize("Node2")
+        self.assertAlmostEqual(res.logScale, 2 * f.logScale)
+        f *= Factor.from_node(self.n1)
+        self.assertAlmostEqual(f.logScale, np.log(1e-200))
+        f.normalize()
+        self.assertEqual(f.logScale, 0.0)
+
+    def test_addition_different_scales(self):
+        f1 = Factor.from_node(self.n1)
+        f2 = Factor.from_node(self.n1)
+        f2.potentials = f2.potentials / 2
+        f2.logScale = np.log(2)
+        res = f1 + f2
+        np.testing.assert_array_almost_equal(np.exp(res.logScale) * res.potentials,
+                                             np.array([0.6, 1.4]))
+
 #    def test_division(self):
 #        self.fail("TODO")
         
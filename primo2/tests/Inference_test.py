@@ -25,7 +25,9 @@ from primo2.networks import BayesianNetwork
 from primo2.nodes import DiscreteNode
 from primo2.io import XMLBIFParser
 from primo2.inference.order import Orderer
+from primo2.inference.pruning import Pruner
 from primo2.inference.exact import VariableElimination
+from primo2.inference.exact import CachingVariableElimination
 from primo2.inference.exact import FactorTree
 
 class EliminationOderTest(unittest.TestCase):
@@ -69,6 +71,61 @@ class EliminationOderTest(unittest.TestCase):
             Orderer.get_min_degree_order("Not a Bayesian Network.")
         self.assertEqual(str(cm.exception), "Only Bayesian Networks are currently supported.")
         
+    def test_heuristic_elimination_order(self):
+        bn = XMLBIFParser.parse("primo2/tests/slippery.xbif")
+        # Ties are broken by the variable names
+        order, width, maxCliqueSize = Orderer.get_heuristic_order(bn, "min_degree")
+        self.assertEqual(order, ["slippery_road", "wet_grass", "rain", "sprinkler", "winter"])
+        self.assertEqual(width, 2)
+        self.assertEqual(maxCliqueSize, 8)
+        self.assertEqual(Orderer.get_min_degree_order(bn), order)
+        order, width, maxCliqueSize = Orderer.get_heuristic_order(bn, "min_fill")
+        self.assertEqual(order, ["slippery_road", "wet_grass", "rain", "sprinkler", "winter"])
+        self.assertEqual(width, 2)
+        self.assertEqual(Orderer.get_heuristic_order(bn, "weighted_min_fill")[0], order)
+        with self.assertRaises(ValueError) as cm:
+            Orderer.get_heuristic_order(bn, "max_degree")
+        self.assertEqual(str(cm.exception), "Unknown heuristic max_degree. Supported " \
+                         "heuristics are ['min_degree', 'min_fill', 'weighted_min_fill'].")
+
+    def test_order_cost(self):
+        bn = XMLBIFParser.parse("primo2/tests/slippery.xbif")
+        order = ["slippery_road", "wet_grass", "rain", "sprinkler", "winter"]
+        self.assertEqual(Orderer.get_order_cost(bn, order), (2, 8, 4+8+8+4+2))
+        self.assertEqual(Orderer.get_order_cost(bn, ["rain"] + order[:2] + order[3:])[0], 4)
+        with self.assertRaises(ValueError):
+            Orderer.get_order_cost(bn, order[1:])
+
+    def test_optimize_order(self):
+        import json
+        import os
+        import shutil
+        import tempfile
+        bn = XMLBIFParser.parse("primo2/tests/slippery.xbif")
+        tempDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempDir)
+        cachePath = os.path.join(tempDir, "order_cache_test.json")
+        order = Orderer.optimize(bn, budgetSeconds=0.05, anneal=True, seed=1,
+                                 useCache=False, cacheFile=cachePath)
+        self.assertEqual(sorted(order), sorted(bn.get_all_node_names()))
+        self.assertEqual(Orderer.get_order_cost(bn, order)[2], 26)
+        # The order is cached by the structure of the network
+        otherBn = XMLBIFParser.parse("primo2/tests/slippery.xbif")
+        self.assertEqual(Orderer.get_structure_hash(otherBn), Orderer.get_structure_hash(bn))
+        self.assertEqual(Orderer.optimize(otherBn, budgetSeconds=10), order)
+        from primo2.inference import order as orderModule
+        orderModule._orderCache.clear()
+        self.assertEqual(Orderer.optimize(otherBn, budgetSeconds=10, cacheFile=cachePath), order)
+        self.assertEqual(os.listdir(tempDir), ["order_cache_test.json"])
+        # A corrupt cache file, e.g. from a crashed process, is treated as empty
+        with open(cachePath, "w") as f:
+            f.write('{"truncated": ')
+        orderModule._orderCache.clear()
+        order = Orderer.optimize(otherBn, budgetSeconds=0.05, cacheFile=cachePath)
+        self.assertEqual(Orderer.get_order_cost(bn, order)[2], 26)
+        with open(cachePath) as f:
+            self.assertEqual(json.load(f)[Orderer.get_structure_hash(bn)]["order"], order)
+
     def test_random_elimination_order(self):
         bn = XMLBIFParser.parse("primo2/tests/slippery.xbif")
         order = Orderer.get_random_order(bn)
@@ -82,6 +139,55 @@ class EliminationOderTest(unittest.TestCase):
             Orderer.get_min_degree_order("Not a Bayesian Network.")
         self.assertEqual(str(cm.exception), "Only Bayesian Networks are currently supported.")
 
+class PruningTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bn = XMLBIFParser.parse("primo2/tests/slippery.xbif")
+
+    def test_barren_nodes(self):
+        self.assertEqual(Pruner.get_ancestral_set(self.bn, ["rain"]), set(["rain", "winter"]))
+        prunedBn, evidence = Pruner.prune_network(self.bn, ["rain"])
+        self.assertEqual(sorted(prunedBn.get_all_node_names()), ["rain", "winter"])
+        # The original network is not modified
+        self.assertEqual(len(self.bn.get_all_node_names()), 5)
+        self.assertEqual(self.bn.get_node("slippery_road").parentOrder, ["rain"])
+
+    def test_prune_edges_of_hard_evidence(self):
+        prunedBn, evidence = Pruner.prune_network(self.bn, ["wet_grass"], {"rain": "false"})
+        self.assertEqual(sorted(prunedBn.get_all_node_names()), 
+                         ["rain", "sprinkler", "wet_grass", "winter"])
+        self.assertEqual(evidence, {"rain": "false"})
+        self.assertEqual(prunedBn.get_node("wet_grass").parentOrder, ["sprinkler"])
+        # Everything but the query is disconnected when the edge out of rain is cut
+        slipperyBn, evidence = Pruner.prune_network(self.bn, ["slippery_road"], {"rain": "false"})
+        self.assertEqual(list(slipperyBn.get_all_node_names()), ["slippery_road"])
+        self.assertEqual(evidence, {})
+        wet = self.bn.get_node("wet_grass")
+        np.testing.assert_array_almost_equal(prunedBn.get_node("wet_grass").cpd, 
+                        np.take(wet.cpd, 1, axis=1+wet.parentOrder.index("rain")))
+        # Soft evidence does not allow to cut edges
+        prunedBn, evidence = Pruner.prune_network(self.bn, ["wet_grass"], 
+                                                  {"rain": np.array([0.2, 0.5])})
+        self.assertEqual(len(prunedBn.get_all_node_names()), 4)
+        self.assertEqual(list(evidence), ["rain"])
+
+    def test_pruned_marginals(self):
+        evidence = {"winter": "true", "slippery_road": "false"}
+        for v in ["rain", "sprinkler", "wet_grass"]:
+            np.testing.assert_array_almost_equal(
+                VariableElimination.naive_marginals(self.bn, [v], evidence).get_potential(),
+                VariableElimination.naive_marginals(self.bn, [v], evidence, prune=False).get_potential())
+            np.testing.assert_array_almost_equal(
+                VariableElimination.bucket_marginals(self.bn, [v], evidence).get_potential(),
+                VariableElimination.naive_marginals(self.bn, [v], evidence, prune=False).get_potential())
+
+    def test_pruned_jointree(self):
+        ft = FactorTree.create_jointree(self.bn, variables=["sprinkler", "winter"])
+        self.assertEqual(sorted(ft.bn.get_all_node_names()), ["sprinkler", "winter"])
+        ft.set_evidence({"winter": "true"})
+        np.testing.assert_array_almost_equal(ft.marginals(["sprinkler"]).get_potential(),
+                VariableElimination.naive_marginals(self.bn, ["sprinkler"], {"winter": "true"}).get_potential())
+
 class VariableEliminationTest(unittest.TestCase):
     
     def setUp(self):
@@ -141,10 +247,51 @@ class VariableEliminationTest(unittest.TestCase):
         resFactor = VariableElimination.bucket_marginals(self.bn, ["wet_grass"], {"winter": "true", "rain": "false"})
         np.testing.assert_array_almost_equal(resFactor.get_potential(), np.array([0.02, 0.98]))
         
-    ### TODO check multiple marginals
-#    def test_bucket_multiple_marginals(self):
-#        resFactor = VariableElimination.bucket_marginals(self.bn, ["wet_grass", "rain"], {"winter": "true", "slippery_road": "false"})
+    def test_bucket_multiple_marginals(self):
+        evidence = {"winter": "true", "slippery_road": "false"}
+        resFactor = VariableElimination.bucket_marginals(self.bn, ["wet_grass", "rain"], evidence)
+        self.assertEqual(resFactor.variableOrder, ["wet_grass", "rain"])
+        naiveFactor = VariableElimination.naive_marginals(self.bn, ["wet_grass", "rain"], evidence)
+        np.testing.assert_array_almost_equal(resFactor.get_potential(),
+                np.transpose(naiveFactor.potentials, [naiveFactor.variableOrder.index(v)
+                                                      for v in resFactor.variableOrder]))
+
+    def test_bucket_marginals_keeps_order(self):
+        order = ["rain", "winter", "sprinkler", "slippery_road", "wet_grass"]
+        resFactor = VariableElimination.bucket_marginals(self.bn, ["rain"], {"wet_grass": "false"},
+                                                         order=order, prune=False)
+        np.testing.assert_array_almost_equal(resFactor.get_potential(), np.array([0.158858, 0.841142]))
+        self.assertEqual(order, ["rain", "winter", "sprinkler", "slippery_road", "wet_grass"])
+
+    def test_caching_marginals(self):
+        cve = CachingVariableElimination(self.bn)
+        evidence = {"winter": "true", "slippery_road": "false"}
+        for v in ["wet_grass", "rain", "sprinkler"]:
+            resFactor = cve.marginals([v], evidence)
+            naiveFactor = VariableElimination.naive_marginals(self.bn, [v], evidence)
+            np.testing.assert_array_almost_equal(resFactor.get_potential(),
+                                                 naiveFactor.get_potential())
+        self.assertTrue(cve.cacheHits > 0)
+        # Repeated queries do not compute any new messages
+        misses = cve.cacheMisses
+        resFactor = cve.marginals(["rain"], evidence)
+        self.assertEqual(cve.cacheMisses, misses)
+        np.testing.assert_array_almost_equal(resFactor.get_potential(), 
+                VariableElimination.naive_marginals(self.bn, ["rain"], evidence).get_potential())
+        # Different evidence is not answered from the cache
+        resFactor = cve.marginals(["rain"], {"winter": "false"})
+        np.testing.assert_array_almost_equal(resFactor.get_potential(), np.array([0.1, 0.9]))
         
+    def test_caching_bounded_size(self):
+        cve = CachingVariableElimination(self.bn, maxCacheSize=4)
+        for v in ["wet_grass", "rain", "sprinkler", "winter"]:
+            resFactor = cve.marginals([v], {"slippery_road": "true"})
+            naiveFactor = VariableElimination.naive_marginals(self.bn, [v], {"slippery_road": "true"})
+            np.testing.assert_array_almost_equal(resFactor.get_potential(),
+                                                 naiveFactor.get_potential())
+            self.assertTrue(cve._cacheSize <= 4)
+
+
         
 class FactorEliminationTest(unittest.TestCase):
     
@@ -237,6 +384,232 @@ class FactorEliminationTest(unittest.TestCase):
         resFactor = ft.marginals(["wet_grass"])
         np.testing.assert_array_almost_equal(resFactor.get_potential(), np.array([0.02, 0.98]))
         
+    def test_jointree_reuses_potentials(self):
+        ft = FactorTree.create_jointree(self.bn)
+        ft.set_evidence({"winter": "true"})
+        potentials = {n: d["factor"].potentials for n, d in ft.tree.nodes(data=True)}
+        ft.set_evidence({"winter": "true", "rain": "false"})
+        for n, d in ft.tree.nodes(data=True):
+            self.assertTrue(d["factor"].potentials is potentials[n])
+        resFactor = ft.marginals(["wet_grass"])
+        np.testing.assert_array_almost_equal(resFactor.get_potential(), np.array([0.02, 0.98]))
+        
+    def test_jointree_fill_in_edges(self):
+        bn = BayesianNetwork()
+        for name in ["a", "b", "c", "d", "e", "f"]:
+            bn.add_node(DiscreteNode(name))
+        for parent, child in [("a","b"), ("a","c"), ("b","d"), ("c","e"), 
+                              ("d","f"), ("e","f")]:
+            bn.add_edge(parent, child)
+        rs = np.random.RandomState(0)
+        for n in bn.get_all_nodes():
+            cpd = rs.rand(*n.cpd.shape)
+            n.set_cpd(cpd / np.sum(cpd, axis=0))
+        ft = FactorTree.create_jointree(bn, order=["a", "b", "c", "d", "e", "f"])
+        ft.set_evidence({"f": "True"})
+        for v in ["a", "b", "c", "d", "e"]:
+            np.testing.assert_array_almost_equal(ft.marginals([v]).get_potential(),
+                VariableElimination.naive_marginals(bn, [v], {"f": "True"}).get_potential())
+
+    def test_jointree_unique_clique_names(self):
+        bn = BayesianNetwork()
+        for name in ["a", "bc", "ab", "c"]:
+            bn.add_node(DiscreteNode(name))
+        bn.add_edge("a", "bc")
+        bn.add_edge("ab", "c")
+        ft = FactorTree.create_jointree(bn, order=["a", "ab", "bc", "c"])
+        # Clusters bc and c are contained in the clusters a,bc and ab,c
+        self.assertEqual(sorted(ft.tree.nodes()), ["abc", "abc#2"])
+        self.assertEqual(ft.tree.number_of_edges(), 0)
+        ft.set_evidence({"a": "True"})
+        np.testing.assert_array_almost_equal(ft.marginals(["bc"]).get_potential(),
+                VariableElimination.naive_marginals(bn, ["bc"], {"a": "True"}).get_potential())
+        with self.assertRaises(ValueError) as cm:
+            FactorTree.create_jointree(bn, order=["a", "ab", "bc"])
+        self.assertEqual(str(cm.exception), "The order needs to contain each " \
+                         "variable of the network exactly once.")
+
+    def test_jointree_save_load(self):
+        import os
+        import shutil
+        import tempfile
+        tempDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempDir)
+        path = os.path.join(tempDir, "jointree_test.npz")
+        ft = FactorTree.create_jointree(self.bn)
+        ft.save(path)
+        for mmap in [True, False]:
+            loaded = FactorTree.load(path, mmap=mmap)
+            self.assertEqual(sorted(loaded.tree.nodes()), sorted(ft.tree.nodes()))
+            loaded.set_evidence({"winter": "true"})
+            np.testing.assert_array_almost_equal(loaded.marginals(["wet_grass"]).get_potential(),
+                                                 np.array([0.668, 0.332]))
+            self.assertAlmostEqual(loaded.get_evidence_probability(), 0.6)
+        self.assertTrue(isinstance(loaded._initialPotentials[0], np.ndarray))
+        with self.assertRaises(ValueError) as cm:
+            loaded.reset_factors()
+        self.assertEqual(str(cm.exception), "The potentials of a jointree without " \
+                         "its BayesianNetwork cannot be recomputed.")
+        # Given the network, the potentials can be recomputed after changes
+        loaded = FactorTree.load(path, bn=self.bn, lazy=True)
+        self.assertTrue(isinstance(loaded._initialPotentials[0], np.memmap))
+        self.bn.get_node("winter").set_cpd(np.array([0.1, 0.9]))
+        loaded.reset_factors()
+        loaded.set_evidence({})
+        np.testing.assert_array_almost_equal(loaded.marginals(["winter"]).get_potential(),
+                                             np.array([0.1, 0.9]))
+        del loaded
+
+    def test_jointree_reset_factors_after_cpd_change(self):
+        ft = FactorTree.create_jointree(self.bn)
+        self.bn.get_node("winter").set_cpd(np.array([0.1, 0.9]))
+        ft.set_evidence({})
+        np.testing.assert_array_almost_equal(ft.marginals(["winter"]).get_potential(), np.array([0.6, 0.4]))
+        ft.reset_factors()
+        ft.set_evidence({})
+        np.testing.assert_array_almost_equal(ft.marginals(["winter"]).get_potential(), np.array([0.1, 0.9]))
+        
+    def test_jointree_longdouble_cpds(self):
+        for node in self.bn.get_all_nodes():
+            node.set_cpd(np.asarray(node.cpd, dtype=np.longdouble))
+        ft = FactorTree.create_jointree(self.bn)
+        ft.set_evidence({"winter": "true"})
+        resFactor = ft.marginals(["wet_grass"])
+        self.assertEqual(resFactor.potentials.dtype, np.longdouble)
+        np.testing.assert_array_almost_equal(resFactor.get_potential(), np.array([0.668, 0.332]))
+        self.assertAlmostEqual(float(ft.get_evidence_probability()), 0.6)
+        
+    def test_jointree_update_evidence(self):
+        ft = FactorTree.create_jointree(self.bn)
+        ft.set_evidence({"winter": "true"})
+        ft.update_evidence({"rain": "false"})
+        resFactor = ft.marginals(["wet_grass"])
+        np.testing.assert_array_almost_equal(resFactor.get_potential(), np.array([0.02, 0.98]))
+        ft.update_evidence({"rain": None, "winter": None, "wet_grass": "false"})
+        resFactor = ft.marginals(["rain"])
+        np.testing.assert_array_almost_equal(resFactor.get_potential(), np.array([0.158858, 0.841142]))
+        
+    def test_jointree_update_evidence_invalidates_dependent_messages(self):
+        ft = FactorTree.create_jointree(self.bn, order=["slippery_road", "wet_grass", 
+                                                        "sprinkler", "winter", "rain"])
+        ft.set_evidence({})
+        numMessages = sum(ft._messageValid)
+        self.assertEqual(numMessages, 2 * ft.tree.number_of_edges())
+        ft.update_evidence({"slippery_road": "true"})
+        # Only the messages directed away from the slippery_road clique are affected
+        self.assertEqual(sum(ft._messageValid), numMessages - ft.tree.number_of_edges())
+        resFactor = ft.marginals(["slippery_road"])
+        np.testing.assert_array_almost_equal(resFactor.get_potential(), np.array([1.0, 0.0]))
+        self.assertEqual(sum(ft._messageValid), numMessages - ft.tree.number_of_edges())
+        
+    def test_jointree_lazy_marginals(self):
+        ft = FactorTree.create_jointree(self.bn, lazy=True)
+        ft.set_evidence({"winter": "true"})
+        self.assertEqual(sum(ft._messageValid), 0)
+        resFactor = ft.marginals(["wet_grass"])
+        np.testing.assert_array_almost_equal(resFactor.get_potential(), np.array([0.668, 0.332]))
+        # Only the inward pass towards the queried clique was performed
+        self.assertEqual(sum(ft._messageValid), ft.tree.number_of_edges())
+        resFactor = ft.marginals(["slippery_road"])
+        np.testing.assert_array_almost_equal(resFactor.get_potential(), 
+                VariableElimination.naive_marginals(self.bn, ["slippery_road"], 
+                                                    {"winter": "true"}).get_potential())
+        
+    def test_jointree_lazy_soft_evidence(self):
+        ft = FactorTree.create_jointree(self.bn, lazy=True)
+        ft.set_evidence({"rain": np.array([0.3, 0.7])}, softPosteriors=True)
+        np.testing.assert_array_almost_equal(ft.marginals(["rain"]).get_potential(), np.array([0.3, 0.7]))
+        
+    def test_jointree_variable_index(self):
+        order = ["slippery_road", "wet_grass", "sprinkler", "winter", "rain"]
+        ft = FactorTree.create_jointree(self.bn, order=order)
+        # rain is contained in all cliques but slippery_roadrain is the smallest
+        self.assertTrue(ft._cliqueNames[ft._find_clique("rain")] in ["slippery_roadrain", "rainslippery_road"])
+        self.assertEqual(ft._cliqueVariables[ft._find_clique(["sprinkler", "winter"])], 
+                         set(["sprinkler", "winter", "rain"]))
+        with self.assertRaises(ValueError) as cm:
+            ft.marginals(["slippery_road", "winter"])
+        self.assertEqual(str(cm.exception), "No clique containing the variables " \
+                         "['slippery_road', 'winter'] was found.")
+
+    def test_jointree_all_marginals(self):
+        ft = FactorTree.create_jointree(self.bn)
+        ft.set_evidence({"winter": "true", "wet_grass": "false"})
+        res = ft.all_marginals()
+        self.assertEqual(set(res), set(self.bn.get_all_node_names()))
+        for var in res:
+            np.testing.assert_array_almost_equal(res[var],
+                                                 ft.marginals([var]).get_potential())
+        names, packed = ft.all_marginals(packed=True)
+        self.assertEqual(names, sorted(res))
+        self.assertEqual(packed.shape, (5, 2))
+        for i, var in enumerate(names):
+            np.testing.assert_array_almost_equal(packed[i], res[var])
+
+    def test_jointree_batch_marginals(self):
+        ft = FactorTree.create_jointree(self.bn)
+        rows = [{}, {"winter": "true"}, {"wet_grass": "false", "rain": "true"},
+                {"slippery_road": np.array([0.3, 0.6]), "sprinkler": None}]
+        variables = ["wet_grass", "rain", "sprinkler"]
+        res = ft.batch_marginals(variables, rows, chunkSize=3)
+        for var in variables:
+            self.assertEqual(res[var].shape, (4, 2))
+        for i, row in enumerate(rows):
+            ft.set_evidence({e: row[e] for e in row if row[e] is not None})
+            for var in variables:
+                np.testing.assert_array_almost_equal(res[var][i],
+                                        ft.marginals([var]).get_potential())
+
+    def test_jointree_batch_marginals_columns(self):
+        ft = FactorTree.create_jointree(self.bn)
+        res = ft.batch_marginals(["wet_grass"], {"winter": ["true", None]})
+        np.testing.assert_array_almost_equal(res["wet_grass"],
+                                        np.array([[0.668, 0.332], [0.4643, 0.5357]]))
+        with self.assertRaises(ValueError) as cm:
+            ft.batch_marginals(["wet_grass"], {"winter": ["maybe"]})
+        self.assertEqual(str(cm.exception), "Evidence maybe is not one of the " \
+                         "possible values (('true', 'false')) for this variable.")
+
+    def test_jointree_evidence_probability(self):
+        ft = FactorTree.create_jointree(self.bn)
+        ft.set_evidence({})
+        self.assertAlmostEqual(ft.get_evidence_probability(), 1.0)
+        ft.set_evidence({"winter": "true"})
+        self.assertAlmostEqual(ft.get_evidence_probability(), 0.6)
+        ft.set_evidence({"winter": "true", "rain": "false"})
+        self.assertAlmostEqual(ft.get_evidence_probability(), 0.12)
+        self.assertAlmostEqual(ft.get_evidence_probability(logarithm=True), np.log(0.12))
+        ft = FactorTree.create_jointree(self.bn, lazy=True)
+        ft.set_evidence({"wet_grass": "true"})
+        self.assertAlmostEqual(ft.get_evidence_probability(), 0.4643)
+
+    def test_jointree_log_likelihood(self):
+        ft = FactorTree.create_jointree(self.bn)
+        rows = [{}, {"winter": "true"}, {"winter": "true", "rain": "false"},
+                {"wet_grass": "true"}]
+        res = ft.log_likelihood(rows, chunkSize=3)
+        np.testing.assert_array_almost_equal(np.exp(res), np.array([1.0, 0.6, 0.12, 0.4643]))
+
+    def test_jointree_no_underflow(self):
+        bn = BayesianNetwork()
+        order = ["x{}".format(i) for i in range(600)]
+        for i, name in enumerate(order):
+            bn.add_node(DiscreteNode(name))
+            if i > 0:
+                bn.add_edge(order[i-1], name)
+        bn.get_node(order[0]).set_cpd(np.array([0.5, 0.5]))
+        for name in order[1:]:
+            bn.get_node(name).set_cpd(np.array([[0.3, 0.7], [0.7, 0.3]]))
+        ft = FactorTree.create_jointree(bn, order=order)
+        # The probability of this evidence is far below the smallest float
+        ft.set_evidence({name: "True" for name in order[:-1]})
+        np.testing.assert_array_almost_equal(ft.marginals([order[-1]]).get_potential(),
+                                             np.array([0.3, 0.7]))
+        self.assertAlmostEqual(ft.get_evidence_probability(logarithm=True),
+                               np.log(0.5) + 598 * np.log(0.3))
+        self.assertAlmostEqual(ft.log_likelihood([{name: "True" for name in order[:-1]}])[0],
+                               np.log(0.5) + 598 * np.log(0.3))
+
     def test_jointree_marginal_soft_evidence(self):
         bn = BayesianNetwork()
         cloth = DiscreteNode("cloth", ["green","blue", "red"])
@@ -21,16 +21,212 @@
 
 import unittest
 
+import numpy as np
+
 from primo2.io import XMLBIFParser
 
+from primo2.inference.exact import VariableElimination
 from primo2.inference.mcmc import MCMC
+from primo2.inference.mcmc import ChainDiagnostics
+from primo2.inference.mcmc import CompiledNetwork
 from primo2.inference.mcmc import GibbsTransition
 from primo2.inference.mcmc import MetropolisHastingsTransition
 
 class MCMCTest(unittest.TestCase):
     
-    #TODO!
-    pass
+    def setUp(self):
+        self.bn = XMLBIFParser.parse("primo2/tests/slippery.xbif")
+        
+    def test_compiled_gibbs_marginals(self):
+        evidence = {"wet_grass": "true"}
+        mcmc = MCMC(self.bn, transitionModel=GibbsTransition(seed=0), 
+                    numSamples=20000, burnIn=100, fullChange=True)
+        res = mcmc.marginals(["rain", "winter"], evidence)
+        self.assertEqual(res.variableOrder, ["rain", "winter"])
+        exact = VariableElimination.bucket_marginals(self.bn, ["rain", "winter"], evidence)
+        np.testing.assert_allclose(res.potentials, exact.potentials, atol=0.02)
+        
+    def test_compiled_metropolis_hastings_marginals(self):
+        evidence = {"wet_grass": "true"}
+        mcmc = MCMC(self.bn, transitionModel=MetropolisHastingsTransition(seed=0), 
+                    numSamples=20000, burnIn=100, fullChange=True)
+        res = mcmc.marginals(["rain"], evidence)
+        exact = VariableElimination.bucket_marginals(self.bn, ["rain"], evidence)
+        np.testing.assert_allclose(res.potentials, exact.potentials, atol=0.02)
+        
+    def test_compiled_gibbs_seeded(self):
+        res1 = MCMC(self.bn, transitionModel=GibbsTransition(seed=3), 
+                    numSamples=100, burnIn=10).marginals(["rain"])
+        res2 = MCMC(self.bn, transitionModel=GibbsTransition(seed=3), 
+                    numSamples=100, burnIn=10).marginals(["rain"])
+        np.testing.assert_array_equal(res1.potentials, res2.potentials)
+        
+    def test_multiple_chains(self):
+        evidence = {"wet_grass": "true"}
+        mcmc = MCMC(self.bn, transitionModel=GibbsTransition(seed=5), numSamples=500, 
+                    burnIn=10, fullChange=True, numChains=3)
+        res = mcmc.marginals(["rain"], evidence)
+        self.assertEqual(len(mcmc.chainStatistics), 3)
+        self.assertEqual(len(set(s["seed"] for s in mcmc.chainStatistics)), 3)
+        pooled = sum(s["counts"] for s in mcmc.chainStatistics)
+        self.assertEqual(np.sum(pooled), 1500)
+        np.testing.assert_array_almost_equal(res.potentials, pooled / 1500)
+        # The chains are independent of the processes they are run in
+        mcmc = MCMC(self.bn, transitionModel=GibbsTransition(seed=5), numSamples=500, 
+                    burnIn=10, fullChange=True, numChains=3, workers=2)
+        np.testing.assert_array_equal(mcmc.marginals(["rain"], evidence).potentials,
+                                      res.potentials)
+        
+    def test_lockstep_chains(self):
+        evidence = {"wet_grass": "true"}
+        mcmc = MCMC(self.bn, transitionModel=GibbsTransition(seed=2), numSamples=100, 
+                    burnIn=20, fullChange=True, numChains=500, lockstep=True)
+        res = mcmc.marginals(["rain", "winter"], evidence)
+        exact = VariableElimination.bucket_marginals(self.bn, ["rain", "winter"], evidence)
+        np.testing.assert_allclose(res.potentials, exact.potentials, atol=0.02)
+        self.assertEqual(len(mcmc.chainStatistics), 500)
+        self.assertEqual(np.sum(mcmc.chainStatistics[0]["counts"]), 100)
+        with self.assertRaises(ValueError) as cm:
+            MCMC(self.bn, transitionModel=MetropolisHastingsTransition(), lockstep=True)
+        self.assertEqual(str(cm.exception), "The transition model does not support lockstep chains.")
+        
+    def test_marginals_diagnostics(self):
+        mcmc = MCMC(self.bn, transitionModel=GibbsTransition(seed=3), numSamples=1000, 
+                    burnIn=50, fullChange=True, numChains=2)
+        mcmc.marginals(["rain"], {"wet_grass": "true"})
+        self.assertEqual(mcmc.diagnostics.numChains, 2)
+        self.assertEqual(mcmc.diagnostics.numSamples, 1000)
+        self.assertEqual(mcmc.diagnostics.burnIn, 50)
+        self.assertTrue(mcmc.diagnostics.rhat() < 1.1)
+        self.assertTrue(0 < mcmc.diagnostics.effective_sample_size() <= 2000)
+        self.assertEqual(mcmc.diagnostics.marginal_variance().shape, (2,))
+        self.assertIsNone(mcmc.diagnostics.converged)
+        
+    def test_marginals_partial_batch(self):
+        mcmc = MCMC(self.bn, transitionModel=GibbsTransition(seed=3), numSamples=1010, 
+                    fullChange=True, numChains=2)
+        mcmc.marginals(["rain"], {"wet_grass": "true"})
+        self.assertEqual(mcmc.chainStatistics[0]["numSamples"], 1010)
+        # The diagnostics only use the 19 full batches of 51 samples
+        self.assertEqual(mcmc.diagnostics.numSamples, 969)
+        
+    def test_marginals_without_samples(self):
+        for numChains in [1, 2]:
+            mcmc = MCMC(self.bn, transitionModel=GibbsTransition(seed=3), numSamples=0, 
+                        numChains=numChains)
+            res = mcmc.marginals(["rain"], {"wet_grass": "true"})
+            np.testing.assert_array_equal(res.potentials, np.array([0, 0]))
+            self.assertEqual(mcmc.chainStatistics[0]["numSamples"], 0)
+            self.assertEqual(mcmc.diagnostics.numSamples, 0)
+        
+    def test_transition_model_without_rng(self):
+        class CustomTransition(GibbsTransition):
+            def __init__(self):
+                # Does not call the constructor of TransitionModel
+                pass
+            compiled = False
+        mcmc = MCMC(self.bn, transitionModel=CustomTransition(), numSamples=200, 
+                    burnIn=20, fullChange=True)
+        res = mcmc.marginals(["rain"], {"wet_grass": "true"})
+        self.assertAlmostEqual(np.sum(res.potentials), 1.0)
+        
+    def test_adaptive_marginals(self):
+        evidence = {"wet_grass": "true"}
+        mcmc = MCMC(self.bn, transitionModel=GibbsTransition(seed=1), 
+                    fullChange=True, numChains=4)
+        res = mcmc.adaptive_marginals(["rain"], evidence, targetPrecision=0.01)
+        self.assertTrue(mcmc.diagnostics.converged)
+        self.assertTrue(mcmc.diagnostics.standard_error() <= 0.01)
+        self.assertTrue(mcmc.diagnostics.numSamples < 100000)
+        self.assertEqual(mcmc.chainStatistics[0]["numSamples"], mcmc.diagnostics.numSamples)
+        self.assertEqual(mcmc.diagnostics.burnIn, mcmc.diagnostics.numSamples)
+        exact = VariableElimination.bucket_marginals(self.bn, ["rain"], evidence)
+        np.testing.assert_allclose(res.potentials, exact.potentials, atol=0.04)
+        # The target can not be reached within maxSamples
+        res = mcmc.adaptive_marginals(["rain"], evidence, targetPrecision=0.0001, 
+                                      maxSamples=1000)
+        self.assertFalse(mcmc.diagnostics.converged)
+        self.assertEqual(mcmc.diagnostics.burnIn + mcmc.diagnostics.numSamples, 1000)
+        with self.assertRaises(ValueError) as cm:
+            mcmc.adaptive_marginals(["rain"], evidence, maxSamples=150, batchSize=100)
+        self.assertEqual(str(cm.exception), "maxSamples needs to be at least twice "\
+                         "the batchSize.")
+        # An odd batch is added to the burn-in
+        res = mcmc.adaptive_marginals(["rain"], evidence, targetPrecision=0.0001, 
+                                      maxSamples=1100)
+        self.assertEqual(mcmc.diagnostics.burnIn, 600)
+        self.assertEqual(mcmc.diagnostics.numSamples, 500)
+        self.assertEqual(mcmc.chainStatistics[0]["numSamples"], 500)
+        
+class ChainDiagnosticsTest(unittest.TestCase):
+    
+    def test_independent_chains(self):
+        randomState = np.random.RandomState(0)
+        counts = randomState.binomial(100, 0.3, size=(4, 20))
+        diagnostics = ChainDiagnostics(np.stack([counts, 100 - counts], axis=2), 100)
+        self.assertEqual(diagnostics.numSamples, 2000)
+        self.assertAlmostEqual(diagnostics.rhat(), 1.0, places=2)
+        self.assertTrue(diagnostics.effective_sample_size() > 4000)
+        np.testing.assert_allclose(diagnostics.marginal_variance(), 
+                                   [0.21 / 8000, 0.21 / 8000], rtol=0.3)
+        
+    def test_stuck_chains(self):
+        counts = np.zeros((2, 10, 2))
+        counts[0, :, 0] = 10
+        counts[1, :, 1] = 10
+        diagnostics = ChainDiagnostics(counts, 10)
+        self.assertEqual(diagnostics.rhat(), np.inf)
+        # A single batch does not allow to compute R-hat
+        self.assertEqual(ChainDiagnostics(counts[:, :1], 10).rhat(), np.inf)
+        
+class CompiledNetworkTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.bn = XMLBIFParser.parse("primo2/tests/slippery.xbif")
+        self.network = CompiledNetwork(self.bn)
+        
+    def test_encode_state(self):
+        state = {"winter": "true", "sprinkler": "false", "rain": "true", 
+                 "wet_grass": "false", "slippery_road": "true"}
+        encoded = self.network.encode_state(state)
+        self.assertEqual(encoded[self.network.index["sprinkler"]], 1)
+        self.assertEqual(encoded[self.network.index["winter"]], 0)
+        self.assertEqual(self.network.decode_state(encoded), state)
+        with self.assertRaises(ValueError):
+            self.network.encode_evidence({"rain": "maybe"})
+    
+    def test_markov_weights(self):
+        state = {"winter": "true", "sprinkler": "false", "rain": "true", 
+                 "wet_grass": "false", "slippery_road": "true"}
+        encoded = self.network.encode_state(state)
+        for name in state:
+            node = self.bn.get_node(name)
+            expected = []
+            for value in node.values:
+                adaptedState = dict(state)
+                adaptedState[name] = value
+                expected.append(node.get_markov_prob(value, self.bn.get_children(name), adaptedState))
+            np.testing.assert_array_almost_equal(
+                    self.network.markov_weights(encoded, self.network.index[name]), expected)
+    
+    def test_markov_weights_batch(self):
+        states = self.network.sample_forward_batch({}, 10, np.random.RandomState(0))
+        for name in self.network.names:
+            variable = self.network.index[name]
+            weights = self.network.markov_weights_batch(states, variable)
+            for i in range(10):
+                np.testing.assert_array_almost_equal(weights[i], 
+                        self.network.markov_weights(states[i], variable))
+    
+    def test_compiled_step_with_evidence(self):
+        gibbs = GibbsTransition(seed=1)
+        evidence = self.network.encode_evidence({"sprinkler": "true"})
+        state = self.network.sample_forward(evidence, gibbs.rng)
+        variables = [i for i in range(len(self.network.names)) if i not in evidence]
+        for i in range(20):
+            state = gibbs.compiled_step(self.network, state, variables, fullChange=True)
+            self.assertEqual(state[self.network.index["sprinkler"]], 0)
+            self.assertTrue(np.all(state < self.network.cardinalities))
     
 class GibbsTransitionTest(unittest.TestCase):
     
@@ -114,6 +310,31 @@ class MetropolisHastingTransitionTest(unittest.TestCase):
                 self.assertEqual(val, evidence[var])
                 
                 
+    def test_step_name_state(self):
+        met = MetropolisHastingsTransition()
+        state = {n.name: n.sample_local(None) for n in self.bn.get_all_nodes()}
+        varsToChange = list(self.bn.get_all_nodes())
+        for i in range(10):
+            state = met.step(state, varsToChange, self.bn, fullChange=False)
+        for name, val in state.items():
+            self.assertTrue(val in self.bn.get_node(name).values)
+            
+    def test_compiled_step_cached_terms(self):
+        import pickle
+        network = CompiledNetwork(self.bn)
+        met = MetropolisHastingsTransition(seed=4)
+        # Copies made before the first step have an empty cache
+        copied = pickle.loads(pickle.dumps(met))
+        self.assertIsNone(copied._cachedValues)
+        self.assertIsNone(copied._cachedTerms)
+        evidence = network.encode_evidence({"sprinkler": "true"})
+        state = network.sample_forward(evidence, met.rng)
+        variables = [i for i in range(len(network.names)) if i not in evidence]
+        for i in range(50):
+            state = met.compiled_step(network, state, variables, fullChange=False)
+            self.assertEqual(state[network.index["sprinkler"]], 0)
+            np.testing.assert_array_almost_equal(met._cachedTerms, network.cpd_terms(state))
+                
     def test_step_with_evidence_fullChange(self):
         """
             As above.